@@ -11,8 +11,6 @@ from setuptools import setup
 
 from setuptools.command.test import test as TestCommand  # noqa: N812
 
-PY26 = sys.version_info[0:2] < (2, 7)
-
 
 class PyTest(TestCommand):
     """Test harness."""
@@ -43,10 +41,9 @@ _package_name = 'travis_log_fetch'
 dependencies = [
     'travispy',
     'github3.py>=1.0.0a1',
-    'parse',
     'python-dateutil',
+    'ConfigArgParse',
 ]
-dependencies.append('ConfigArgParse>=0.10.0' if PY26 else 'ConfigArgParse')
 
 _package_init_py = os.path.join(os.path.dirname(__file__),
                                 _package_name,
@@ -68,6 +65,10 @@ setup(
     packages=find_packages(),
     version=version,
     install_requires=dependencies,
+    python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*',
+    extras_require={
+        'zstd': ['zstandard>=0.15'],
+    },
     entry_points={
         'console_scripts': [
             'travis_log_fetch = travis_log_fetch:main',
@@ -0,0 +1,76 @@
+"""
+Benchmark stored log filename parsing.
+
+Compares the parse library, as previously used by get_stored_targets,
+with compile_format.  Run with: PYTHONPATH=. python tests/benchmark_parse.py
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import timeit
+
+import parse
+
+from travis_log_fetch._filename import DEFAULT_FORMAT, compile_format
+from travis_log_fetch._target import Target
+
+ALT_FORMAT = '{job.state}/{job.repository.slug}/{job.number}.txt'
+
+COUNT = 100000
+
+
+class _Job(object):
+
+    def __init__(self, i):
+        self.repository = self
+        self.slug = 'user{0}/project'.format(i % 10)
+        self.number = '{0}.{1}'.format(i // 10 + 1, i % 10 + 1)
+        self.state = 'passed'
+
+
+def _filenames(log_filename_format):
+    """Generate filenames of many jobs."""
+    return [log_filename_format.format(job=_Job(i)) for i in range(COUNT)]
+
+
+def parse_library(log_filename_format, filenames):
+    """Parse filenames with the parse library into Target objects."""
+    log_filename_format = log_filename_format.replace(
+        '{job.state}', '{job.state:w}').replace(
+        '{job.number}', '{job.number:f}')
+    parser = parse.compile(log_filename_format)
+
+    targets = []
+    for filename in filenames:
+        parsed_filename = parser.parse(filename)
+        target = Target()
+        target.slug = parsed_filename['job.repository.slug']
+        target.number = str(parsed_filename['job.number'])
+        target.state = parsed_filename['job.state']
+        targets.append(target)
+    return targets
+
+
+def compiled_format(log_filename_format, filenames):
+    """Parse filenames with compile_format into StoredLog tuples."""
+    parser = compile_format(log_filename_format)
+    return [parser(filename) for filename in filenames]
+
+
+def main():
+    """Print the time to parse COUNT filenames of each format."""
+    for name, log_filename_format in (('default', DEFAULT_FORMAT),
+                                      ('alternative', ALT_FORMAT)):
+        filenames = _filenames(log_filename_format)
+        times = {}
+        for function in (parse_library, compiled_format):
+            times[function] = min(timeit.repeat(
+                lambda: function(log_filename_format, filenames),
+                number=1, repeat=3))
+            print('{0} format, {1}: {2:.3f}s for {3} filenames'.format(
+                name, function.__name__, times[function], COUNT))
+        print('{0} format speedup: {1:.1f}x'.format(
+            name, times[parse_library] / times[compiled_format]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Test stored log filename parsing."""
+from __future__ import absolute_import, unicode_literals
+
+from travis_log_fetch._filename import (
+    DEFAULT_FORMAT,
+    StoredLog,
+    _compile_regex,
+    compile_format,
+)
+
+import pytest
+
+NAMES = [
+    ('a/b/10.2-passed.txt', StoredLog('a/b', 10, 2, 'passed')),
+    ('a/b-c/12.10-errored.txt', StoredLog('a/b-c', 12, 10, 'errored')),
+    ('a/b/10.2.txt', None),
+    ('a/b/10-passed.txt', None),
+    ('a/b/x.2-passed.txt', None),
+    ('a/b/c/10.2-passed.txt', None),
+    ('a/10.2-passed.txt', None),
+    ('a/b/10.2-passed.log', None),
+    ('a/b/10.2-pass-ed.txt', None),
+]
+
+
+class TestDefaultFormat(object):
+
+    @pytest.mark.parametrize('filename,expected', NAMES)
+    def test_fast_path(self, filename, expected):
+        assert compile_format(DEFAULT_FORMAT)(filename) == expected
+
+    @pytest.mark.parametrize('filename,expected', NAMES)
+    def test_regex(self, filename, expected):
+        match = _compile_regex(DEFAULT_FORMAT).match(filename)
+        if expected:
+            assert match.group('slug', 'state') == (expected.slug,
+                                                    expected.state)
+            assert int(match.group('job_number')) == expected.job_number
+        else:
+            assert not match
+
+
+class TestOtherFormats(object):
+
+    def test_alt_layout(self):
+        parser = compile_format(
+            '{job.state}/{job.repository.slug}/{job.number}.txt')
+        assert parser('passed/a/b/3.1.txt') == StoredLog('a/b', 3, 1,
+                                                         'passed')
+        assert parser('passed/a/b/3.1-passed.txt') is None
+
+    def test_bucket(self):
+        parser = compile_format(
+            '{job.repository.slug}/{job.build_bucket}/{job.number}.log')
+        assert parser('a/b/1000/1234.1.log') == StoredLog('a/b', 1234, 1,
+                                                          None)
+        assert parser('a/b/1234.1.log') is None
+
+    def test_other_fields(self):
+        parser = compile_format('{job.id}/{job.repository.slug}.log')
+        assert parser('123/a/b.log') == StoredLog('a/b', None, None, None)
+        assert parser('1/2/a/b.log') is None
+
+    def test_repeated_field(self):
+        parser = compile_format('{job.number}/{job.number}-{job.state}')
+        assert parser('1.2/1.2-passed') == StoredLog(None, 1, 2, 'passed')
+        assert parser('1.2/1.3-passed') is None
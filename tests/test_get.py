@@ -0,0 +1,360 @@
+"""Test resolution using a fake Travis client."""
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+import time
+
+from travis_log_fetch import cmdline, config, get
+from travis_log_fetch._target import Target
+from travis_log_fetch.get import (
+    get_completed,
+    get_forks,
+    get_historical_build,
+    get_historical_builds,
+    get_jobs,
+    get_many_forks,
+    get_travis_repos,
+    iter_jobs,
+    iter_recent_builds,
+    get_historical_job,
+)
+
+import travispy
+
+import pytest
+
+
+class FakeObject(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeTravis(object):
+
+    page_size = 3
+
+    def __init__(self, slug, build_numbers, jobs_per_build=2):
+        self._session = FakeObject(uri='http://invalid')
+        self.calls = []
+        self._builds = []
+        self._jobs = {}
+        for i, number in enumerate(build_numbers):
+            build_id = 1000 + i
+            job_ids = [build_id * 10 + j for j in range(jobs_per_build)]
+            for j, job_id in enumerate(job_ids, 1):
+                self._jobs[job_id] = self._entity(
+                    travispy.Job, id=job_id, number='{0}.{1}'.format(number, j),
+                    state='passed', build_id=build_id)
+            self._builds.append(dict(
+                id=build_id, number=str(number), job_ids=job_ids,
+                state='passed', finished_at='2017-01-01T00:00:00Z',
+                repository_id=1, slug=slug))
+
+    def _entity(self, cls, **kwargs):
+        entity = cls(self._session)
+        for key, value in kwargs.items():
+            setattr(entity, key, value)
+        return entity
+
+    def _build(self, info, jobs=False):
+        info = dict(info)
+        del info['slug']
+        build = self._entity(travispy.Build, **info)
+        if jobs:
+            build.jobs = [self._jobs[job_id] for job_id in info['job_ids']]
+        return build
+
+    def builds(self, slug, after_number=None):
+        self.calls.append(('builds', after_number))
+        builds = [info for info in self._builds
+                  if info['slug'] == slug and
+                  (after_number is None or
+                   int(info['number']) < int(after_number))]
+        return [self._build(info) for info in builds[:self.page_size]]
+
+    def build(self, build_id):
+        self.calls.append(('build', build_id))
+        for info in self._builds:
+            if info['id'] == build_id:
+                return self._build(info, jobs=True)
+
+    def job(self, job_id):
+        self.calls.append(('job', job_id))
+        return self._jobs[job_id]
+
+    def repo(self, slug):
+        self.calls.append(('repo', slug))
+        builds = [info for info in self._builds if info['slug'] == slug]
+        if not builds:
+            raise travispy.errors.TravisError(
+                {'error': 'not found', 'status_code': 404})
+        return self._entity(travispy.Repo, slug=slug, id=1,
+                            last_build_id=builds[0]['id'])
+
+    def jobs(self, ids):
+        self.calls.append(('jobs', ids))
+        return [self._jobs[int(job_id)] for job_id in ids.split(',')]
+
+    def user(self):
+        return None
+
+
+class BrokenJobsTravis(FakeTravis):
+
+    def jobs(self, ids):
+        self.calls.append(('jobs', ids))
+        return []
+
+
+@pytest.fixture(autouse=True)
+def clear_build_ids():
+    get._build_ids.clear()
+    get._repo_slugs.clear()
+    get._no_job_batches.clear()
+    get._missing_repos = get.MissingRepos()
+
+
+class TestHistoricalBuild(object):
+
+    def test_single_page(self):
+        t = FakeTravis('a/b', range(20, 0, -1))
+        build = get_historical_build(t, Target.from_extended_slug('a/b/15'))
+        assert build.number == '15'
+        assert len(build.jobs) == 2
+        assert t.calls == [('builds', 16), ('build', 1005)]
+
+    def test_memoised(self):
+        t = FakeTravis('a/b', range(20, 0, -1))
+        target = Target.from_extended_slug('a/b/15.2')
+        get_historical_job(t, target)
+        del t.calls[:]
+
+        job = get_historical_job(t, target)
+        assert job.number == '15.2'
+        assert t.calls == [('build', 1005)]
+
+    def test_duplicate(self):
+        t = FakeTravis('a/b', [5, 4, 4, 3])
+        pytest.raises(AssertionError, get_historical_build, t,
+                      Target.from_extended_slug('a/b/4'))
+
+    def test_missing(self):
+        t = FakeTravis('a/b', [5, 3])
+        pytest.raises(AssertionError, get_historical_build, t,
+                      Target.from_extended_slug('a/b/4'))
+
+
+class TestJobBatches(object):
+
+    def test_batch(self):
+        t = FakeTravis('a/b', range(20, 0, -1), jobs_per_build=40)
+        builds = list(get_historical_builds(t, 'a/b', _after=3))
+        assert [build.number for build in builds] == ['2', '1']
+        assert [job.number for job in builds[1].jobs][:2] == ['1.1', '1.2']
+        assert [call[0] for call in t.calls] == [
+            'builds', 'jobs', 'jobs', 'builds']
+
+    def test_fallback(self):
+        t = BrokenJobsTravis('a/b', range(20, 0, -1))
+        builds = list(get_historical_builds(t, 'a/b', _after=3))
+        assert [job.number for job in builds[0].jobs] == ['2.1', '2.2']
+        assert len([call for call in t.calls if call[0] == 'job']) == 4
+        assert len([call for call in t.calls if call[0] == 'jobs']) == 1
+
+
+class TestResolve(object):
+
+    targets = ['a/b', 'a/b/3', 'a/b/2.2', 'c/d', 'a/b/1']
+
+    def _resolve(self, resolver, **kwargs):
+        t = FakeTravis('a/b', range(20, 0, -1))
+        targets = [Target.from_extended_slug(target)
+                   for target in self.targets]
+        return [job.number for job in resolver(t, targets, **kwargs)]
+
+    def test_get_jobs(self):
+        assert self._resolve(get_jobs) == [
+            '20.1', '20.2', '3.1', '3.2', '2.2', '1.1', '1.2']
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_iter_jobs(self, workers):
+        assert (self._resolve(iter_jobs, workers=workers) ==
+                self._resolve(get_jobs))
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_recent_builds(self, workers):
+        t = FakeTravis('a/b', range(20, 0, -1))
+        t2 = FakeTravis('c/d', range(5, 0, -1))
+        t._builds += t2._builds
+        targets = [Target.from_simple_slug('a/b'),
+                   Target.from_simple_slug('c/d')]
+        builds = iter_recent_builds(t, targets, 4, workers)
+        assert [build.number for build in builds] == [
+            '20', '19', '18', '17', '5', '4', '3', '2']
+
+
+class TestCompleted(object):
+
+    def test_generator(self):
+        t = FakeTravis('a/b', [2, 1])
+        t._jobs[10000].state = 'started'
+
+        def jobs():
+            for job_id in sorted(t._jobs):
+                yield t.job(job_id)
+
+        completed = get_completed(t, jobs(), 0)
+        assert next(completed).id == 10001
+        t._jobs[10000].state = 'passed'
+        assert [job.id for job in completed] == [10010, 10011, 10000]
+
+    def test_poll_delay(self):
+        now = time.time()
+        started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(now - 100))
+        queued = FakeObject(started_at=None)
+        running = FakeObject(started_at=started)
+
+        assert get._poll_delay(queued, 3, 30, None, now) == 30
+        assert get._poll_delay(running, 0, 30, None, now) == 30
+        assert get._poll_delay(running, 1, 30, None, now) == 60
+        assert get._poll_delay(running, 5, 30, None, now) == 120
+        # expected to finish in 500 seconds
+        assert 240 < get._poll_delay(running, 0, 100, 600, now) <= 250
+        assert get._poll_delay(running, 0, 30, 600, now) == 120
+        assert get._poll_delay(running, 0, 30, 110, now) == 5
+        # overdue
+        assert get._poll_delay(running, 0, 30, 50, now) == 5
+        assert get._poll_delay(running, 2, 30, 50, now) == 20
+        assert get._poll_delay(running, 5, 30, 50, now) == 30
+
+    def test_early_finish(self):
+        t = FakeTravis('a/b', [2, 1])
+        for job in t._jobs.values():
+            job.state = 'started'
+            job.started_at = None
+
+        completed = get_completed(t, list(t._jobs.values()), 0)
+        t._jobs[10011].state = 'passed'
+        assert next(completed).id == 10011
+        for job in t._jobs.values():
+            job.state = 'passed'
+        assert sorted(job.id for job in completed) == [10000, 10001, 10010]
+
+
+class FakeFork(FakeObject):
+
+    def as_dict(self):
+        return {'pushed_at': self.raw_pushed_at}
+
+
+class FakeGithub(object):
+
+    def __init__(self, forks):
+        self._forks = forks
+        self.calls = []
+
+    def repository(self, username, project):
+        self.calls.append('{0}/{1}'.format(username, project))
+        forks = self._forks['{0}/{1}'.format(username, project)]
+        return FakeObject(forks=lambda: forks)
+
+
+class TestForks(object):
+
+    def _github(self):
+        return FakeGithub({
+            'a/b': [
+                FakeFork(full_name='c/b', raw_pushed_at='2016-01-01T00:00:00Z'),
+                FakeFork(full_name='d/b', raw_pushed_at='2015-01-01T00:00:00Z'),
+                FakeFork(full_name='e/b', raw_pushed_at=None),
+            ],
+            'x/y': [
+                FakeFork(full_name='z/y', raw_pushed_at='2016-01-01T00:00:00Z'),
+            ],
+        })
+
+    def test_pushed_after(self):
+        gh = self._github()
+        assert get_forks(gh, 'a/b') == ['c/b', 'd/b', 'e/b']
+        assert get_forks(gh, 'a/b', datetime.datetime(2015, 6, 1)) == ['c/b']
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_many(self, workers):
+        gh = self._github()
+        assert get_many_forks(gh, ['a/b', 'x/y'], workers=workers) == [
+            'c/b', 'd/b', 'e/b', 'z/y']
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_many_duplicates(self, workers):
+        gh = self._github()
+        assert get_many_forks(gh, ['x/y', 'a/b', 'x/y'],
+                              workers=workers) == ['z/y', 'c/b', 'd/b', 'e/b']
+        assert sorted(gh.calls) == ['a/b', 'x/y']
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_travis_repos(self, workers):
+        t = FakeTravis('c/b', [1])
+        repos = get_travis_repos(t, ['c/b', 'd/b', 'e/b'], workers)
+        assert [repo.slug for repo in repos] == ['c/b']
+        assert sorted(slug for call, slug in t.calls) == ['c/b', 'd/b', 'e/b']
+
+        del t.calls[:]
+        repos = get_travis_repos(t, ['c/b', 'd/b', 'e/b'], workers)
+        assert [repo.slug for repo in repos] == ['c/b']
+        assert t.calls == [('repo', 'c/b')]
+
+
+class TestMissingRepos(object):
+
+    def test_persistent(self, tmpdir):
+        t = FakeTravis('c/b', [1])
+        get.use_missing_repos(str(tmpdir), 60)
+        repos = get_travis_repos(t, ['c/b', 'd/b'])
+        get._missing_repos.close()
+        assert [repo.slug for repo in repos] == ['c/b']
+
+        del t.calls[:]
+        get.use_missing_repos(str(tmpdir), 60)
+        get_travis_repos(t, ['c/b', 'd/b'])
+        get._missing_repos.close()
+        assert t.calls == [('repo', 'c/b')]
+
+    def test_expired(self, tmpdir):
+        t = FakeTravis('c/b', [1])
+        missing = get.MissingRepos(str(tmpdir), 60)
+        missing.add((t._session.uri, 'd/b'))
+        missing.close()
+
+        assert (t._session.uri, 'd/b') in get.MissingRepos(str(tmpdir), 60)
+        assert (t._session.uri, 'd/b') not in get.MissingRepos(str(tmpdir),
+                                                               -1)
+
+
+class TestForceAll(object):
+
+    @pytest.mark.parametrize('workers', [1, 3])
+    def test_skip_fresh(self, tmpdir, monkeypatch, workers):
+        for number in ('3.1', '3.2', '2.1'):
+            tmpdir.join('a', 'b', '{0}-passed.txt'.format(number)).write(
+                'log', ensure=True)
+
+        t = FakeTravis('a/b', [3, 2, 1])
+        options = config.get_parser().parse_args(
+            ['--force', '--all', '--engine', 'threaded',
+             '--jobs', str(workers), '--dir', str(tmpdir), 'a/b'])
+        monkeypatch.setattr(config, '_options', options)
+        monkeypatch.setattr(config, '_travispy', t)
+
+        downloaded = []
+        monkeypatch.setattr(
+            cmdline, 'download_job_logs',
+            lambda base_dir, jobs, *args: downloaded.extend(jobs))
+
+        cmdline.main()
+
+        assert [job.number for job in downloaded] == [
+            '2.1', '2.2', '1.1', '1.2']
+        # The jobs of both builds are fetched together, and no repo is
+        assert [call for call in t.calls if call[0] != 'builds'] == [
+            ('jobs', '10010,10011,10020,10021')]
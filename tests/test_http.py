@@ -0,0 +1,266 @@
+"""Test HTTP transport."""
+from __future__ import absolute_import, unicode_literals
+
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+import travispy
+
+from travis_log_fetch import config, get
+from travis_log_fetch._http import (
+    ConditionalAdapter,
+    RateLimitAdapter,
+    RateLimiter,
+    ResponseCache,
+    ValidatorCache,
+    default_ttl_policy,
+)
+
+import pytest
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    etag = '"v1"'
+    requests = []
+    limited = 0
+    failing = False
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if Handler.failing:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if Handler.limited:
+            Handler.limited -= 1
+            self.send_response(403)
+            self.send_header('X-RateLimit-Remaining', '0')
+            self.send_header('X-RateLimit-Reset', str(time.time() + 0.2))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = b'{"repo": {"id": 1}}'
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.requests = []
+    Handler.limited = 0
+    Handler.failing = False
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{0}'.format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+class TestConditional(object):
+
+    def _session(self, cache):
+        session = requests.Session()
+        session.mount('http://', ConditionalAdapter(cache=cache))
+        return session
+
+    def test_not_modified(self, tmpdir, server):
+        url = server + '/repos/foo/bar'
+        cache = ValidatorCache(str(tmpdir))
+
+        r = self._session(cache).get(url)
+        assert r.status_code == 200
+        assert r.json() == {'repo': {'id': 1}}
+        assert 'If-None-Match' not in Handler.requests[0]
+
+        cache.close()
+        cache = ValidatorCache(str(tmpdir))
+
+        r = self._session(cache).get(url)
+        assert r.status_code == 200
+        assert r.json() == {'repo': {'id': 1}}
+        assert Handler.requests[1]['If-None-Match'] == '"v1"'
+
+    def test_body_size(self, tmpdir, server):
+        url = server + '/repos/foo/bar'
+        cache = ValidatorCache(str(tmpdir), max_body_size=4)
+
+        self._session(cache).get(url)
+        assert cache.get(url) == ('"v1"', None, None)
+
+        r = self._session(cache).get(url)
+        assert r.status_code == 200
+        assert 'If-None-Match' not in Handler.requests[1]
+
+    def test_expiry(self, tmpdir, server):
+        url = server + '/repos/foo/bar'
+        cache = ValidatorCache(str(tmpdir), ttl=-1)
+        self._session(cache).get(url)
+        assert cache.get(url) is None
+        cache.close()
+
+        cache = ValidatorCache(str(tmpdir))
+        assert cache._db.execute(
+            'SELECT COUNT(*) FROM validators').fetchone()[0] == 0
+
+    def test_no_cache(self, server):
+        url = server + '/repos/foo/bar'
+        session = self._session(None)
+        session.get(url)
+        session.get(url)
+        assert 'If-None-Match' not in Handler.requests[1]
+
+
+class TestResponseCache(object):
+
+    def test_policy(self):
+        url = 'https://api.travis-ci.org/builds?slug=a%2Fb'
+        assert default_ttl_policy(url, {'repo': {}}, 10) == 10
+        assert default_ttl_policy(
+            url, {'build': {'state': 'passed'}}, 10) is None
+        assert default_ttl_policy(
+            url, {'job': {'state': 'started'}}, 10) == 0
+        assert default_ttl_policy(
+            url, {'builds': [{'state': 'passed'}]}, 10) == 10
+        assert default_ttl_policy(
+            url + '&after_number=5', {'builds': [{'state': 'passed'}]},
+            10) is None
+
+    def test_lru(self):
+        cache = ResponseCache(maxsize=2, ttl=10)
+        for i in range(3):
+            cache.store('/repos/{0}'.format(i), b'{"repo": {}}')
+        assert cache.get('/repos/0') is None
+        assert cache.get('/repos/1') == b'{"repo": {}}'
+        cache.store('/repos/3', b'{"repo": {}}')
+        assert cache.get('/repos/2') is None
+        assert cache.get('/repos/1') is not None
+
+    def test_expiry(self, tmpdir):
+        cache = ResponseCache(ttl=-1, base_dir=str(tmpdir))
+        cache.store('/repos/a', b'{"repo": {}}')
+        cache.store('/builds/1', b'{"build": {"state": "passed"}}')
+        assert cache.get('/repos/a') is None
+
+        cache.close()
+        cache = ResponseCache(base_dir=str(tmpdir))
+        assert cache.get('/builds/1') == b'{"build": {"state": "passed"}}'
+
+    def test_pending_job(self):
+        cache = ResponseCache()
+        cache.store('/jobs/1', b'{"job": {"state": "started"}}')
+        assert cache.get('/jobs/1') is None
+
+    def test_disk_expiry(self, tmpdir):
+        cache = ResponseCache(base_dir=str(tmpdir), disk_ttl=-1)
+        cache.store('/builds/1', b'{"build": {"state": "passed"}}')
+        assert cache.get('/builds/1') == b'{"build": {"state": "passed"}}'
+        cache.close()
+
+        cache = ResponseCache(base_dir=str(tmpdir))
+        assert cache._db.execute(
+            'SELECT COUNT(*) FROM responses').fetchone()[0] == 0
+        assert cache.get('/builds/1') is None
+
+    def test_adapter(self, server):
+        url = server + '/repos/foo/bar'
+        session = requests.Session()
+        session.mount('http://', ConditionalAdapter(
+            responses=ResponseCache()))
+
+        assert session.get(url).json() == {'repo': {'id': 1}}
+        assert session.get(url).json() == {'repo': {'id': 1}}
+        assert len(Handler.requests) == 1
+
+
+class TestRetry(object):
+
+    def test_server_error(self, server, monkeypatch):
+        options = config.get_parser().parse_args(['--backoff', '0'])
+        monkeypatch.setattr(config, '_options', options)
+        monkeypatch.setattr(get, '_missing_repos', get.MissingRepos())
+        Handler.failing = True
+
+        t = travispy.TravisPy(uri=server)
+        t._session.mount('http://', RateLimitAdapter(
+            max_retries=config._get_retry()))
+
+        assert get.get_travis_repo(t, 'foo/bar') is None
+        assert len(Handler.requests) == options.retries + 1
+        assert (t._session.uri, 'foo/bar') not in get._missing_repos
+
+
+class TestRateLimit(object):
+
+    def test_token_bucket(self):
+        limiter = RateLimiter(rate=20)
+        start = time.time()
+        for i in range(5):
+            limiter.acquire('http://example.com/a')
+        assert time.time() - start >= 0.15
+        assert limiter.remaining() == {'example.com': None}
+
+    def test_quota(self):
+        limiter = RateLimiter(reserve=0)
+        limiter.update('http://example.com/a', {
+            'X-RateLimit-Remaining': '2',
+            'X-RateLimit-Reset': str(time.time() + 0.3)})
+        limiter.acquire('http://example.com/a')
+        limiter.acquire('http://example.com/b')
+        assert limiter.exhausted('http://example.com/a')
+        assert limiter.remaining() == {'example.com': 0}
+        assert not limiter.exhausted('http://example.org/a')
+
+        start = time.time()
+        limiter.acquire('http://example.com/a')
+        assert time.time() - start >= 0.2
+        assert limiter.remaining()['example.com'] is None
+
+    def test_spread(self):
+        limiter = RateLimiter(reserve=10)
+        limiter.update('http://example.com/a', {
+            'X-RateLimit-Remaining': '5',
+            'X-RateLimit-Reset': str(time.time() + 0.5)})
+        start = time.time()
+        for i in range(3):
+            limiter.acquire('http://example.com/a')
+        assert time.time() - start >= 0.15
+
+    def test_retry_after(self):
+        limiter = RateLimiter()
+        limiter.update('http://example.com/a', {'Retry-After': '60'})
+        assert limiter.exhausted('http://example.com/a')
+
+    def test_adapter_waits_for_reset(self, server):
+        Handler.limited = 1
+        limiter = RateLimiter()
+        session = requests.Session()
+        session.mount('http://', RateLimitAdapter(limiter=limiter))
+
+        r = session.get(server + '/repos/foo/bar')
+        assert r.status_code == 200
+        assert len(Handler.requests) == 2
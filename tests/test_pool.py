@@ -0,0 +1,58 @@
+"""Test worker thread pools."""
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from travis_log_fetch import _pool
+
+import pytest
+
+
+class Counter(object):
+
+    def __init__(self, count):
+        self.count = count
+        self.taken = 0
+
+    def __iter__(self):
+        for i in range(self.count):
+            self.taken += 1
+            yield i
+
+
+def _slow_square(i):
+    time.sleep(0.01)
+    return i * i
+
+
+def _fail_on_three(i):
+    if i == 3:
+        raise ValueError(i)
+    return i
+
+
+class TestImap(object):
+
+    @pytest.mark.parametrize('ordered', [True, False])
+    def test_bounded(self, ordered):
+        items = Counter(10000)
+        results = _pool.imap(_slow_square, items, 2, ordered=ordered)
+        next(results)
+        time.sleep(0.1)
+        assert items.taken <= 5
+        results.close()
+
+    def test_ordered(self):
+        assert list(_pool.imap(_slow_square, range(20), 3)) == [
+            i * i for i in range(20)]
+
+    def test_unordered(self):
+        assert sorted(_pool.imap(_slow_square, range(20), 3,
+                                 ordered=False)) == [i * i for i in range(20)]
+
+    @pytest.mark.parametrize('ordered', [True, False])
+    def test_error(self, ordered):
+        items = Counter(10000)
+        with pytest.raises(ValueError):
+            list(_pool.imap(_fail_on_three, items, 2, ordered=ordered))
+        assert items.taken < 10
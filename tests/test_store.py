@@ -1,11 +1,28 @@
 """Test log store."""
 from __future__ import absolute_import, unicode_literals
 
+import io
+import os
+import shutil
+import time
+
+from travis_log_fetch import _compress, _store
+from travis_log_fetch._http import ValidatorCache
 from travis_log_fetch._store import (
+    StoreIndex,
+    clean,
+    download_job_logs,
     get_repo_stored_builds,
     get_stored_repo_slugs,
     get_stored_targets,
+    iter_skip_fresh,
+    iter_skip_stored,
+    remove_temp_files,
+    reshard,
+    scan,
+    skip_stored,
 )
+from travis_log_fetch._target import Target
 
 import pytest
 
@@ -59,3 +76,674 @@ class TestAltLayout(object):
 
         assert builds
         assert 'foo/bar/7' in builds
+
+
+class TestIndex(object):
+
+    layout = '{job.repository.slug}/{job.number}-{job.state}.txt'
+
+    @pytest.fixture
+    def base_dir(self, tmpdir):
+        base_dir = os.path.join(str(tmpdir), 'logs')
+        shutil.copytree('./tests/default_layout', base_dir)
+        return base_dir
+
+    def test_refresh(self, base_dir):
+        index = StoreIndex(base_dir)
+        index.refresh()
+
+        assert index.get_files() == [
+            os.path.join('wikimedia', 'pywikibot-core', '3052.11-passed.txt')]
+        assert index.get_dirs(2) == [
+            os.path.join('wikimedia', 'pywikibot-core')]
+
+        targets = get_stored_targets(base_dir, self.layout, index)
+        assert 'wikimedia/pywikibot-core/3052.11' in targets
+
+        slugs = get_stored_repo_slugs(base_dir, self.layout, index)
+        assert slugs == ['wikimedia/pywikibot-core']
+
+    def test_incremental(self, base_dir):
+        index = StoreIndex(base_dir)
+        index.refresh()
+        index.close()
+
+        new_dir = os.path.join(base_dir, 'foo', 'bar')
+        os.makedirs(new_dir)
+        open(os.path.join(new_dir, '1.1-passed.txt'), 'w').close()
+        shutil.rmtree(os.path.join(base_dir, 'wikimedia'))
+
+        index = StoreIndex(base_dir)
+        index.refresh()
+
+        targets = get_stored_targets(base_dir, self.layout, index)
+        assert targets == ['foo/bar/1.1']
+        assert index.get_dirs(2) == [os.path.join('foo', 'bar')]
+
+    def test_not_stored(self, base_dir):
+        StoreIndex(base_dir).close()
+
+        targets = get_stored_targets(base_dir, self.layout)
+        assert targets == ['wikimedia/pywikibot-core/3052.11']
+
+
+class TestScan(object):
+
+    @pytest.fixture
+    def base_dir(self, tmpdir):
+        for user in ('a', 'b'):
+            for project in ('x', 'y'):
+                for number in ('1.1', '1.2'):
+                    tmpdir.join(user, project, number + '-passed.txt').write(
+                        'log', ensure=True)
+        tmpdir.join('a', 'x', '1000', '1000.1-passed.txt').write(
+            'log', ensure=True)
+        tmpdir.join('.travis_log_fetch.sqlite').write('')
+        tmpdir.join('.travis_log_fetch.objects', 'ab').write('', ensure=True)
+        if hasattr(os, 'symlink'):
+            os.symlink(str(tmpdir.join('a', 'x')), str(tmpdir.join('b', 'z')))
+        return str(tmpdir)
+
+    @pytest.mark.parametrize('workers', [1, 4])
+    @pytest.mark.parametrize('no_scandir', [False, True])
+    def test_scan(self, base_dir, workers, no_scandir, monkeypatch):
+        if no_scandir:
+            monkeypatch.setattr(_store, 'scandir', None)
+
+        entries = dict(scan(base_dir, workers=workers))
+        expected = set(os.path.join(user, project, number + '-passed.txt')
+                       for user in ('a', 'b') for project in ('x', 'y')
+                       for number in ('1.1', '1.2'))
+        expected.add(os.path.join('a', 'x', '1000', '1000.1-passed.txt'))
+        if hasattr(os, 'symlink'):
+            expected.add(os.path.join('b', 'z'))
+        assert set(entries) == expected
+
+        filename = os.path.join('a', 'y', '1.1-passed.txt')
+        assert entries[filename].stat().st_size == 3
+
+        dirs = set(path for path, entry in scan(base_dir, 2, True, workers)
+                   if entry.is_dir() and not entry.is_symlink())
+        assert dirs == set(['a', 'b', os.path.join('a', 'x'),
+                            os.path.join('a', 'y'), os.path.join('b', 'y'),
+                            os.path.join('b', 'x')])
+
+    def test_lazy(self, tmpdir, monkeypatch):
+        for user in range(20):
+            tmpdir.join(str(user), 'x', '1.1-passed.txt').write(
+                'log', ensure=True)
+
+        scanned = []
+
+        def _scan_subtree(base_dir, max_depth, include_dirs, path):
+            scanned.append(path)
+            return [(path, None)]
+
+        monkeypatch.setattr(_store, '_scan_subtree', _scan_subtree)
+        entries = scan(str(tmpdir), workers=2)
+        next(entries)
+        time.sleep(0.1)
+        assert len(scanned) <= 5
+        assert len(list(entries)) == 19
+        assert len(scanned) == 20
+
+    def test_missing(self, tmpdir):
+        assert list(scan(str(tmpdir.join('missing')))) == []
+
+    def test_slugs(self, base_dir):
+        assert sorted(get_stored_repo_slugs(
+            base_dir, '{job.repository.slug}/{job.number}-{job.state}.txt')
+        ) == ['a/x', 'a/y', 'b/x', 'b/y']
+
+
+class TestSkipStored(object):
+
+    base_dir = './tests/alt_layout'
+    layout = '{job.state}/{job.repository.slug}/{job.number}.txt'
+
+    def test_skip(self):
+        targets = [
+            Target.from_extended_slug('a/b/10'),
+            Target.from_extended_slug('a/b/11'),
+            Target.from_extended_slug('a/b/10.1'),
+            Target.from_extended_slug('foo/bar/10'),
+            Target.from_extended_slug('foo/bar/7'),
+            Target.from_simple_slug('a/b'),
+        ]
+        new_targets = skip_stored(targets, self.base_dir, self.layout)
+
+        assert new_targets == [
+            'a/b/11',
+            'a/b/10.1',
+            'foo/bar/10',
+            'a/b',
+        ]
+
+
+class FakeObject(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def fake_job(slug, number, body, state='passed'):
+    return FakeObject(
+        id=int(number.replace('.', '')), number=number, state=state,
+        finished_at=None, repository=FakeObject(slug=slug),
+        log=FakeObject(body=body), _session=FakeObject(uri='http://invalid'))
+
+
+def fake_build(slug, number, job_count, finished_at):
+    return FakeObject(
+        number=str(number), job_ids=list(range(job_count)),
+        finished_at=finished_at, repository=FakeObject(slug=slug))
+
+
+class TestSkipFresh(object):
+
+    layout = '{job.repository.slug}/{job.number}-{job.state}.txt'
+
+    def _store(self, tmpdir, number, mtime):
+        filename = tmpdir.join('a', 'b', '{0}-passed.txt'.format(number))
+        filename.ensure()
+        os.utime(str(filename), (mtime, mtime))
+
+    @pytest.mark.parametrize('indexed', [False, True])
+    def test_skip(self, tmpdir, indexed):
+        self._store(tmpdir, '10.1', 1500000000)
+        self._store(tmpdir, '10.2', 1500000000)
+        self._store(tmpdir, '11.1', 1500000000)
+        self._store(tmpdir, '12.1', 1500000000)
+        self._store(tmpdir, '12.2', 1400000000)
+
+        index = None
+        if indexed:
+            index = StoreIndex(str(tmpdir))
+            index.refresh()
+
+        finished = '2017-01-01T00:00:00Z'
+        builds = [
+            fake_build('a/b', 10, 2, finished),
+            fake_build('a/b', 11, 2, finished),
+            fake_build('a/b', 12, 2, finished),
+            fake_build('a/b', 13, 1, finished),
+            fake_build('a/b', 10, 2, '2018-01-01T00:00:00Z'),
+            fake_build('a/b', 10, 2, None),
+            Target.from_extended_slug('a/b/10'),
+        ]
+        remaining = list(iter_skip_fresh(builds, str(tmpdir), self.layout,
+                                         index))
+
+        assert remaining == builds[1:]
+
+
+class TestClean(object):
+
+    layout = '{job.repository.slug}/{job.number}-{job.state}.txt'
+
+    def _store(self, tmpdir, name, mtime):
+        filename = tmpdir.join('a', 'b', name)
+        filename.write('log', ensure=True)
+        os.utime(str(filename), (mtime, mtime))
+
+    @pytest.mark.parametrize('indexed', [False, True])
+    def test_clean(self, tmpdir, indexed):
+        self._store(tmpdir, '10.1-started.txt', 100)
+        self._store(tmpdir, '10.1-passed.txt', 200)
+        self._store(tmpdir, '10.2-started.txt', 100)
+        self._store(tmpdir, '11.1-errored.txt', 100)
+        self._store(tmpdir, '11.1-started.txt', 150)
+        self._store(tmpdir, '11.1-passed.txt', 200)
+        self._store(tmpdir, '12.1-passed.txt', 100)
+        self._store(tmpdir, '12.1-started.txt', 200)
+
+        index = None
+        if indexed:
+            index = StoreIndex(str(tmpdir))
+            index.refresh()
+
+        superseded = [
+            os.path.join('a', 'b', '10.1-started.txt'),
+            os.path.join('a', 'b', '11.1-errored.txt'),
+            os.path.join('a', 'b', '11.1-started.txt'),
+        ]
+        assert clean(str(tmpdir), self.layout, index,
+                     dry_run=True) == superseded
+        assert len(tmpdir.join('a', 'b').listdir()) == 8
+
+        assert clean(str(tmpdir), self.layout, index) == superseded
+        assert sorted(path.basename
+                      for path in tmpdir.join('a', 'b').listdir()) == [
+            '10.1-passed.txt', '10.2-started.txt', '11.1-passed.txt',
+            '12.1-passed.txt', '12.1-started.txt']
+
+        assert clean(str(tmpdir), self.layout, index) == []
+
+
+class TestDownload(object):
+
+    layout = '{job.repository.slug}/{job.number}-{job.state}.txt'
+
+    def test_workers(self, tmpdir):
+        base_dir = str(tmpdir)
+        jobs = [fake_job('foo/bar', '{0}.1'.format(i), 'log {0}'.format(i))
+                for i in range(1, 11)]
+        download_job_logs(base_dir, jobs, self.layout, workers=4)
+
+        targets = get_stored_targets(base_dir, self.layout)
+        assert len(targets) == 10
+        assert 'foo/bar/10.1' in targets
+        with open(os.path.join(base_dir, 'foo/bar/3.1-passed.txt')) as f:
+            assert f.read() == 'log 3'
+
+    def test_failure(self, tmpdir):
+        class BrokenLog(object):
+
+            @property
+            def body(self):
+                raise ValueError('broken')
+
+        jobs = [fake_job('foo/bar', '1.1', 'log')]
+        jobs[0].log = BrokenLog()
+        pytest.raises(ValueError, download_job_logs, str(tmpdir), jobs,
+                      self.layout, workers=2)
+
+
+class TestShard(object):
+
+    layout = '{job.repository.slug}/{job.number}-{job.state}.txt'
+    sharded = ('{job.repository.slug}/{job.build_bucket}/'
+               '{job.number}-{job.state}.txt')
+
+    def test_download(self, tmpdir):
+        base_dir = str(tmpdir)
+        jobs = [fake_job('foo/bar', '999.1', 'log'),
+                fake_job('foo/bar', '1000.1', 'log'),
+                fake_job('foo/bar', '2500.2', 'log')]
+        download_job_logs(base_dir, jobs, self.sharded)
+
+        assert tmpdir.join('foo', 'bar', '0', '999.1-passed.txt').check()
+        assert tmpdir.join('foo', 'bar', '1000', '1000.1-passed.txt').check()
+        assert tmpdir.join('foo', 'bar', '2000', '2500.2-passed.txt').check()
+
+        targets = get_stored_targets(base_dir, self.sharded)
+        assert sorted(target.number for target in targets) == [
+            '1000.1', '2500.2', '999.1']
+        assert get_stored_repo_slugs(base_dir, self.sharded) == ['foo/bar']
+
+    @pytest.mark.parametrize('indexed', [False, True])
+    def test_reshard(self, tmpdir, indexed):
+        base_dir = str(tmpdir)
+        for name in ('999.1-passed.txt', '2500.2-failed.txt.gz',
+                     '12.10-passed.txt'):
+            tmpdir.join('foo', 'bar', name).write('log', ensure=True)
+
+        index = None
+        if indexed:
+            index = StoreIndex(base_dir)
+            index.refresh()
+
+        assert reshard(base_dir, self.layout, self.sharded, index,
+                       dry_run=True) == 3
+        assert len(tmpdir.join('foo', 'bar').listdir()) == 3
+
+        assert reshard(base_dir, self.layout, self.sharded, index) == 3
+        assert tmpdir.join('foo', 'bar', '0', '999.1-passed.txt').check()
+        assert tmpdir.join('foo', 'bar', '0', '12.10-passed.txt').check()
+        assert tmpdir.join('foo', 'bar', '2000',
+                           '2500.2-failed.txt.gz').check()
+
+        assert reshard(base_dir, self.sharded, self.layout, index) == 3
+        assert sorted(path.basename
+                      for path in tmpdir.join('foo', 'bar').listdir()) == [
+            '12.10-passed.txt', '2500.2-failed.txt.gz', '999.1-passed.txt']
+
+    def test_reshard_other_field(self, tmpdir):
+        base_dir = str(tmpdir)
+        tmpdir.join('foo', 'bar', '999.1-passed.txt').write('log', ensure=True)
+
+        by_id = '{job.repository.slug}/{job.id}.txt'
+        pytest.raises(ValueError, reshard, base_dir, self.layout, by_id)
+        pytest.raises(ValueError, reshard, base_dir, by_id, self.layout)
+        assert tmpdir.join('foo', 'bar').listdir() == [
+            tmpdir.join('foo', 'bar', '999.1-passed.txt')]
+
+
+class FakeResponse(object):
+
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        # split multi-byte characters across chunks
+        for i in range(0, len(self.content), 3):
+            yield self.content[i:i + 3]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+
+    status_code = 200
+    etag = None
+
+    def __init__(self, content):
+        self.content = content
+        self.urls = []
+        self.headers = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.urls.append(url)
+        self.headers.append(headers)
+        response = FakeResponse(self.content)
+        response.status_code = self.status_code
+        response.headers = {}
+        if self.etag:
+            response.headers['ETag'] = self.etag
+            if headers and headers.get('If-None-Match') == self.etag:
+                response.status_code = 304
+        return response
+
+
+class TestStream(object):
+
+    layout = '{job.repository.slug}/{job.number}-{job.state}.txt'
+
+    def test_stream(self, tmpdir):
+        base_dir = str(tmpdir)
+        text = 'café ☃\nline two\n'
+        session = FakeSession(text.encode('utf-8'))
+        jobs = [fake_job('foo/bar', '1.1', None)]
+        download_job_logs(base_dir, jobs, self.layout, session=session,
+                          stream=True)
+
+        assert session.urls == ['http://invalid/jobs/11/log']
+        assert os.listdir(os.path.join(base_dir, 'foo/bar')) == [
+            '1.1-passed.txt']
+        with io.open(os.path.join(base_dir, 'foo/bar/1.1-passed.txt'),
+                     encoding='utf-8', newline='') as f:
+            assert f.read() == text
+
+    def test_invalid(self, tmpdir):
+        base_dir = str(tmpdir)
+        session = FakeSession(b'\xff\xfe')
+        jobs = [fake_job('foo/bar', '1.1', None)]
+        pytest.raises(UnicodeDecodeError, download_job_logs, base_dir, jobs,
+                      self.layout, session=session, stream=True)
+        assert os.listdir(os.path.join(base_dir, 'foo/bar')) == []
+
+
+class TestTempFiles(object):
+
+    layout = '{job.repository.slug}/{job.number}-{job.state}.txt'
+
+    def _create(self, base_dir, age):
+        directory = os.path.join(base_dir, 'foo', 'bar')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(
+            directory, '.1.{0}-passed.txt.abc.tmp'.format(age))
+        open(filename, 'w').close()
+        mtime = time.time() - age
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_atomic_failure(self, tmpdir):
+        base_dir = str(tmpdir)
+        filename = os.path.join(base_dir, 'foo/bar/1.1-passed.txt')
+        os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write('old')
+
+        session = FakeSession(b'new \xff')
+        jobs = [fake_job('foo/bar', '1.1', None)]
+        pytest.raises(UnicodeDecodeError, download_job_logs, base_dir, jobs,
+                      self.layout, session=session, stream=True)
+
+        assert os.listdir(os.path.dirname(filename)) == ['1.1-passed.txt']
+        with open(filename) as f:
+            assert f.read() == 'old'
+
+    @pytest.mark.skipif(os.name == 'nt', reason='no POSIX modes')
+    def test_mode(self, tmpdir):
+        base_dir = str(tmpdir)
+        download_job_logs(base_dir, [fake_job('foo/bar', '1.1', 'log')],
+                          self.layout)
+        filename = os.path.join(base_dir, 'foo/bar/1.1-passed.txt')
+        assert os.stat(filename).st_mode & 0o777 == 0o666 & ~_store._UMASK
+
+        os.chmod(filename, 0o640)
+        jobs = [fake_job('foo/bar', '1.1', 'new log')]
+        download_job_logs(base_dir, jobs, self.layout)
+        assert os.stat(filename).st_mode & 0o777 == 0o640
+
+    def test_remove(self, tmpdir):
+        base_dir = str(tmpdir)
+        old = self._create(base_dir, 7200)
+        new = self._create(base_dir, 0)
+
+        assert get_stored_targets(base_dir, self.layout) == []
+
+        assert remove_temp_files(base_dir) == 1
+        assert not os.path.exists(old)
+        assert os.path.exists(new)
+
+    def test_remove_indexed(self, tmpdir):
+        base_dir = str(tmpdir)
+        old = self._create(base_dir, 7200)
+        new = self._create(base_dir, 0)
+
+        index = StoreIndex(base_dir)
+        index.refresh()
+        assert index.get_files() == []
+        assert len(index.get_temp_files()) == 2
+
+        assert remove_temp_files(base_dir, index) == 1
+        assert not os.path.exists(old)
+        assert os.path.exists(new)
+        assert index.get_temp_files() == [os.path.relpath(new, base_dir)]
+
+    @pytest.mark.parametrize('sweep', [False, True])
+    def test_sweep_while_skipping(self, tmpdir, sweep):
+        base_dir = str(tmpdir)
+        old = self._create(base_dir, 7200)
+        new = self._create(base_dir, 0)
+
+        targets = [Target.from_extended_slug('foo/bar/1')]
+        assert list(iter_skip_stored(targets, base_dir, self.layout,
+                                     sweep=sweep)) == targets
+        assert os.path.exists(old) != sweep
+        assert os.path.exists(new)
+
+
+class TestCompress(object):
+
+    layout = '{job.repository.slug}/{job.number}-{job.state}.txt'
+
+    @pytest.mark.parametrize('compression', ['gzip', 'xz', 'zstd'])
+    @pytest.mark.parametrize('stream', [False, True])
+    def test_compress(self, tmpdir, compression, stream):
+        try:
+            _compress._check_available(compression)
+        except RuntimeError as e:
+            pytest.skip(str(e))
+
+        base_dir = str(tmpdir)
+        text = 'café ☃\n' * 100
+        session = FakeSession(text.encode('utf-8'))
+        jobs = [fake_job('foo/bar', '1.1', None if stream else text)]
+        download_job_logs(base_dir, jobs, self.layout, session=session,
+                          stream=stream, compression=compression)
+
+        filename = '1.1-passed.txt' + _compress.EXTENSIONS[compression]
+        assert os.listdir(os.path.join(base_dir, 'foo/bar')) == [filename]
+
+        filename = os.path.join(base_dir, 'foo/bar', filename)
+        assert os.path.getsize(filename) < len(text)
+        with _compress.open_log(filename) as f:
+            assert f.read() == text
+
+        assert get_stored_targets(base_dir, self.layout) == ['foo/bar/1.1']
+
+
+@pytest.mark.skipif(not hasattr(os, 'link'), reason='no hardlinks')
+class TestDedup(object):
+
+    layout = '{job.repository.slug}/{job.number}-{job.state}.txt'
+
+    def _download(self, base_dir, compression=None):
+        jobs = [fake_job('foo/bar', '1.1', 'same log'),
+                fake_job('foo/bar', '1.2', 'other log'),
+                fake_job('baz/bar', '5.1', 'same log')]
+        for job in jobs:
+            job.finished_at = '2017-01-01T00:00:00Z'
+        download_job_logs(base_dir, jobs, self.layout, compression=compression,
+                          dedup=True)
+
+    @pytest.mark.parametrize('compression', [None, 'gzip'])
+    def test_dedup(self, tmpdir, compression):
+        base_dir = str(tmpdir)
+        self._download(base_dir, compression)
+
+        extension = _compress.EXTENSIONS.get(compression, '')
+        first = os.stat(os.path.join(
+            base_dir, 'foo/bar/1.1-passed.txt' + extension))
+        second = os.stat(os.path.join(
+            base_dir, 'baz/bar/5.1-passed.txt' + extension))
+        other = os.stat(os.path.join(
+            base_dir, 'foo/bar/1.2-passed.txt' + extension))
+        assert first.st_ino == second.st_ino
+        assert first.st_nlink == 2
+        assert os.path.islink(os.path.join(
+            base_dir, 'baz/bar/5.1-passed.txt' + extension))
+        assert other.st_ino != first.st_ino
+        assert other.st_nlink == 2
+
+        assert sorted(str(target) for target in get_stored_targets(
+            base_dir, self.layout)) == [
+            'baz/bar/5.1', 'foo/bar/1.1', 'foo/bar/1.2']
+
+        with _compress.open_log(os.path.join(
+                base_dir, 'baz/bar/5.1-passed.txt' + extension)) as f:
+            assert f.read() == 'same log'
+
+    @pytest.mark.skipif(os.utime not in getattr(
+        os, 'supports_follow_symlinks', ()), reason='no lutimes')
+    def test_restart_then_identical(self, tmpdir):
+        base_dir = str(tmpdir)
+
+        def _download(slug, number, body, state, mtime):
+            job = fake_job(slug, number, body, state)
+            job.finished_at = '1970-01-01T00:00:10Z'
+            download_job_logs(base_dir, [job], self.layout, dedup=True)
+            filename = os.path.join(
+                base_dir, slug, '{0}-{1}.txt'.format(number, state))
+            os.utime(filename, (mtime, mtime), follow_symlinks=False)
+            return filename
+
+        passed = _download('a/b', '10.1', 'same log', 'passed', 100)
+        _download('a/b', '10.1', 'other log', 'failed', 200)
+        _download('c/d', '5.1', 'same log', 'passed', 300)
+        _download('e/f', '5.1', 'same log', 'passed', 400)
+
+        assert os.lstat(passed).st_mtime == 100
+        assert clean(base_dir, self.layout, dry_run=True) == [
+            os.path.join('a', 'b', '10.1-passed.txt')]
+
+        # Touching one link does not change the others
+        _store._touch(os.path.join(base_dir, 'e/f/5.1-passed.txt'))
+        assert os.lstat(passed).st_mtime == 100
+        assert os.lstat(os.path.join(
+            base_dir, 'c/d/5.1-passed.txt')).st_mtime == 300
+
+    def test_reshard(self, tmpdir):
+        base_dir = str(tmpdir)
+        self._download(base_dir)
+        sharded = '{job.repository.slug}/{job.build_bucket}/{job.number}.txt'
+        layout = '{job.repository.slug}/{job.number}.txt'
+        for name in ('1.1-passed.txt', '1.2-passed.txt'):
+            os.remove(os.path.join(base_dir, 'foo', 'bar', name))
+        os.rename(os.path.join(base_dir, 'baz/bar/5.1-passed.txt'),
+                  os.path.join(base_dir, 'baz/bar/5.1.txt'))
+
+        assert reshard(base_dir, layout, sharded) == 1
+        filename = os.path.join(base_dir, 'baz/bar/0/5.1.txt')
+        assert os.path.islink(filename)
+        with _compress.open_log(filename) as f:
+            assert f.read() == 'same log'
+
+        assert clean(base_dir, self.layout) == []
+        objects = tmpdir.join('.travis_log_fetch.objects')
+        assert len(list(objects.visit(lambda path: path.isfile()))) == 1
+
+    def test_clean_orphans(self, tmpdir):
+        base_dir = str(tmpdir)
+        self._download(base_dir)
+        tmpdir.join('foo', 'bar', '1.2-started.txt').write('')
+        os.utime(str(tmpdir.join('foo', 'bar', '1.2-started.txt')), (1, 1))
+        os.remove(os.path.join(base_dir, 'foo/bar/1.1-passed.txt'))
+        os.remove(os.path.join(base_dir, 'baz/bar/5.1-passed.txt'))
+
+        objects = tmpdir.join('.travis_log_fetch.objects')
+        assert len(list(objects.visit(lambda path: path.isfile()))) == 2
+        clean(base_dir, self.layout, dry_run=True)
+        assert len(list(objects.visit(lambda path: path.isfile()))) == 2
+        assert clean(base_dir, self.layout) == [
+            os.path.join('foo', 'bar', '1.2-started.txt')]
+        assert len(list(objects.visit(lambda path: path.isfile()))) == 1
+
+
+class TestConditional(object):
+
+    layout = '{job.repository.slug}/{job.number}-{job.state}.txt'
+
+    def test_not_modified(self, tmpdir):
+        base_dir = str(tmpdir)
+        filename = os.path.join(base_dir, 'foo/bar/1.1-started.txt')
+        os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write('old')
+        os.utime(filename, (0, 0))
+
+        validators = ValidatorCache(base_dir)
+        response = FakeResponse(b'')
+        response.headers = {'ETag': '"abc"'}
+        validators.store('http://invalid/jobs/11/log', response)
+
+        session = FakeSession(b'')
+        session.status_code = 304
+        jobs = [fake_job('foo/bar', '1.1', 'new', state='started')]
+        download_job_logs(base_dir, jobs, self.layout, session=session,
+                          validators=validators)
+
+        assert session.headers == [{'If-None-Match': '"abc"'}]
+        with open(filename) as f:
+            assert f.read() == 'old'
+        assert os.stat(filename).st_mtime > 0
+
+    def test_download_twice(self, tmpdir):
+        base_dir = str(tmpdir)
+        validators = ValidatorCache(base_dir)
+        session = FakeSession(b'log')
+        session.etag = '"abc"'
+        jobs = [fake_job('foo/bar', '1.1', None, state='started')]
+
+        download_job_logs(base_dir, jobs, self.layout, session=session,
+                          validators=validators)
+        assert validators.get('http://invalid/jobs/11/log')[0] == '"abc"'
+
+        filename = os.path.join(base_dir, 'foo/bar/1.1-started.txt')
+        os.utime(filename, (0, 0))
+        download_job_logs(base_dir, jobs, self.layout, session=session,
+                          validators=validators)
+
+        assert session.headers == [{}, {'If-None-Match': '"abc"'}]
+        with open(filename) as f:
+            assert f.read() == 'log'
+        assert os.stat(filename).st_mtime > 0
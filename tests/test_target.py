@@ -1,7 +1,7 @@
 """Test Target class."""
 from __future__ import absolute_import, unicode_literals
 
-from travis_log_fetch._target import Target
+from travis_log_fetch._target import Target, TargetSet
 
 import pytest
 
@@ -127,3 +127,71 @@ class TestUrl(object):
         assert target.job_id == 10000
         assert target.build_number is None
         assert target.job_number is None
+
+
+class TestIdentity(object):
+
+    def test_eq(self):
+        assert Target.from_extended_slug('foo/bar/10.1') == 'foo/bar/10.1'
+        assert (Target.from_extended_slug('foo/bar/10.1') ==
+                Target.from_extended_slug('foo/bar#10.1'))
+        assert (Target.from_extended_slug('foo/bar/10.1') !=
+                Target.from_extended_slug('foo/bar/10.2'))
+        assert (Target.from_extended_slug('foo/bar/10') !=
+                Target('foo', 'bar', build_id=99, build_number=10))
+
+    def test_hash(self):
+        targets = set([
+            Target.from_extended_slug('foo/bar/10.1'),
+            Target.from_extended_slug('foo/bar#10.1'),
+            Target.from_url('//travis-ci.org/foo/bar/jobs/10000'),
+            Target.from_extended_slug('foo/bar:10000'),
+        ])
+        assert len(targets) == 2
+
+    def test_cached_key(self):
+        target = Target.from_simple_slug('foo/bar')
+        assert target.key is target.key
+        assert hash(target) == hash('foo/bar')
+
+        target.number = '10.1'
+        assert target.key == ('foo', 'bar', 10, 1, None, None)
+        assert hash(target) == hash('foo/bar/10.1')
+
+        target.slug = 'foo/baz'
+        assert target == 'foo/baz/10.1'
+        assert hash(target) == hash('foo/baz/10.1')
+
+        target.state = 'passed'
+        assert target.key == ('foo', 'baz', 10, 1, None, None)
+
+    def test_slots(self):
+        target = Target.from_simple_slug('foo/bar')
+        pytest.raises(AttributeError, setattr, target, 'foo', 1)
+
+
+class TestTargetSet(object):
+
+    def test_order(self):
+        targets = TargetSet([
+            Target.from_simple_slug('foo/bar'),
+            Target.from_extended_slug('foo/bar/10.1'),
+            Target.from_simple_slug('foo/baz'),
+            Target.from_extended_slug('foo/bar#10.1'),
+            Target.from_url('https://travis-ci.org/foo/bar'),
+        ])
+        assert len(targets) == 3
+        assert list(targets) == ['foo/bar', 'foo/bar/10.1', 'foo/baz']
+
+    def test_add(self):
+        targets = TargetSet()
+        assert targets.add(Target.from_simple_slug('foo/bar'))
+        assert not targets.add(Target.from_simple_slug('foo/bar'))
+        assert Target.from_simple_slug('foo/bar') in targets
+
+    def test_string_lookup(self):
+        target = Target.from_extended_slug('a/b/1')
+        assert target == 'a/b/1'
+        assert hash(target) == hash('a/b/1')
+        assert 'a/b/1' in TargetSet([target])
+        assert 'a/b/2' not in TargetSet([target])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Compressed log files."""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import gzip
+import io
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {
+    'gzip': '.gz',
+    'xz': '.xz',
+    'zstd': '.zst',
+}
+
+_MODULES = {
+    'gzip': gzip,
+    'xz': lzma,
+    'zstd': zstandard,
+}
+
+
+def _check_available(compression):
+    """Raise RuntimeError if the module for compression is not installed."""
+    if compression not in EXTENSIONS:
+        raise ValueError('unknown compression {0}'.format(compression))
+    if not _MODULES[compression]:
+        raise RuntimeError('{0} compression is not available'.format(
+            compression))
+
+
+def get_compression(filename):
+    """Get the compression of filename based on its extension."""
+    for compression, extension in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return compression
+
+
+def strip_extension(filename):
+    """Remove a compression extension from filename."""
+    compression = get_compression(filename)
+    if compression:
+        return filename[:-len(EXTENSIONS[compression])]
+    return filename
+
+
+def compressor(fileobj, compression):
+    """
+    Wrap a binary file object in a compressing writer.
+
+    Closing the writer completes the compressed stream, but does not
+    close fileobj.
+    """
+    _check_available(compression)
+    if compression == 'gzip':
+        # A fixed mtime makes identical logs compress identically
+        return gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=0)
+    elif compression == 'xz':
+        return lzma.LZMAFile(fileobj, 'wb')
+    else:
+        return zstandard.ZstdCompressor().stream_writer(
+            fileobj, closefd=False)
+
+
+def open_log(filename):
+    """Open a stored log for reading text, decompressing it if needed."""
+    compression = get_compression(filename)
+    if not compression:
+        return io.open(filename, encoding='utf-8', newline='')
+
+    _check_available(compression)
+    if compression == 'gzip':
+        stream = gzip.GzipFile(filename, 'rb')
+    elif compression == 'xz':
+        stream = lzma.LZMAFile(filename, 'rb')
+    else:
+        stream = zstandard.ZstdDecompressor().stream_reader(
+            io.open(filename, 'rb'), closefd=True)
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='')
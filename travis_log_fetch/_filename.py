@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Parse stored log filenames."""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import re
+
+from collections import namedtuple
+
+DEFAULT_FORMAT = '{job.repository.slug}/{job.number}-{job.state}.txt'
+
+# Fields parsed from a stored log filename; missing fields are None
+StoredLog = namedtuple('StoredLog',
+                       ('slug', 'build_number', 'job_number', 'state'))
+
+_FIELD = re.compile(r'\{([^{}:]*)(?::[^{}]*)?\}')
+
+_WORD = re.compile(r'\w+$', re.UNICODE)
+
+_FIELD_PATTERNS = {
+    'job.repository.slug': r'(?P<slug>[^/]+/[^/]+)',
+    'job.number': r'(?P<build_number>\d+)\.(?P<job_number>\d+)',
+    'job.state': r'(?P<state>\w+)',
+    'job.build_bucket': r'\d+',
+}
+
+# Other fields match within one path component, and are not kept
+_OTHER_FIELD_PATTERN = r'[^/]+?'
+
+
+def _parse_default(filename):
+    """Parse a filename of DEFAULT_FORMAT without a regex."""
+    parts = filename.split('/')
+    if len(parts) != 3 or not parts[0] or not parts[1]:
+        return None
+
+    name = parts[2]
+    if name[-4:] != '.txt':
+        return None
+
+    number, _, state = name[:-4].rpartition('-')
+    build_number, _, job_number = number.partition('.')
+    if not build_number.isdigit() or not job_number.isdigit():
+        return None
+    if not state.isalnum() and not _WORD.match(state):
+        return None
+
+    try:
+        return StoredLog(filename[:-len(name) - 1], int(build_number),
+                         int(job_number), state)
+    except ValueError:
+        # Digits of other scripts
+        return None
+
+
+def _compile_regex(log_filename_format):
+    """Compile a log filename format into one regex."""
+    pattern = []
+    names = set()
+    position = 0
+    for match in _FIELD.finditer(log_filename_format):
+        pattern.append(re.escape(log_filename_format[position:match.start()]))
+        name = match.group(1)
+        field_pattern = _FIELD_PATTERNS.get(name, _OTHER_FIELD_PATTERN)
+        if name in names and name in _FIELD_PATTERNS:
+            # Repeated fields must match the same text as the first one
+            field_pattern = re.sub(r'\(\?P<(\w+)>[^)]*\)', r'(?P=\1)',
+                                   field_pattern)
+        names.add(name)
+        pattern.append(field_pattern)
+        position = match.end()
+    pattern.append(re.escape(log_filename_format[position:]))
+
+    return re.compile(''.join(pattern) + '$', re.UNICODE)
+
+
+def compile_format(log_filename_format):
+    """
+    Compile a parser of stored log filenames.
+
+    The parser returns a StoredLog, or None if the filename does not
+    match the format.
+    """
+    if log_filename_format == DEFAULT_FORMAT:
+        return _parse_default
+
+    regex = _compile_regex(log_filename_format)
+
+    def _parse(filename):
+        match = regex.match(filename)
+        if not match:
+            return None
+
+        fields = match.groupdict()
+        build_number = fields.get('build_number')
+        job_number = fields.get('job_number')
+        return StoredLog(
+            fields.get('slug'),
+            int(build_number) if build_number else None,
+            int(job_number) if job_number else None,
+            fields.get('state'))
+
+    return _parse
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""HTTP transport."""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from logging import getLogger
+
+if sys.version_info[0] == 2:
+    from urlparse import parse_qs, urlparse
+else:
+    from urllib.parse import parse_qs, urlparse
+
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+__logs__ = getLogger(__package__)
+
+FINISHED_STATES = set(['passed', 'failed', 'errored', 'canceled'])
+
+# Expiry of a response which never changes
+FOREVER = None
+
+# Seconds responses and validators are kept on disk, even if they never
+# change, as restarted builds and jobs change again
+DISK_TTL = 24 * 60 * 60
+
+# Largest response body kept with its validators
+_MAX_BODY_SIZE = 64 * 1024
+
+
+class ValidatorCache(object):
+    """
+    Persistent cache of HTTP validators.
+
+    The ETag and Last-Modified headers of each response are kept per URL
+    in a SQLite database in the log directory, so later requests can be
+    conditional.  Bodies of at most max_body_size bytes are also kept, to
+    be reused when the server responds with 304 Not Modified.  Entries
+    are kept for ttl seconds, and expired entries are removed when the
+    cache is opened.
+    """
+
+    filename = '.travis_log_fetch.http.sqlite'
+
+    def __init__(self, base_dir, ttl=DISK_TTL,
+                 max_body_size=_MAX_BODY_SIZE):
+        """Open or create the cache in base_dir."""
+        if not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+
+        self.ttl = ttl
+        self.max_body_size = max_body_size
+        self._db = sqlite3.connect(os.path.join(base_dir, self.filename),
+                                   check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS validators '
+            '(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+            'body BLOB, expires REAL)')
+        try:
+            self._db.execute('ALTER TABLE validators ADD COLUMN expires REAL')
+        except sqlite3.OperationalError:
+            # Created with the column
+            pass
+        self._db.execute(
+            'DELETE FROM validators WHERE expires IS NULL OR expires < ?',
+            (time.time(), ))
+        self._db.commit()
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
+
+    def get(self, url):
+        """Get tuple of etag, last_modified and body of url, or None."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT etag, last_modified, body FROM validators '
+                'WHERE url = ? AND expires >= ?',
+                (url, time.time())).fetchone()
+
+    def conditional_headers(self, url):
+        """Get headers to make a request for url conditional."""
+        row = self.get(url)
+        if not row:
+            return {}
+
+        etag, last_modified, body = row
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def store(self, url, response, body=None):
+        """Store the validators of a response, and optionally its body."""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if body is not None and len(body) > self.max_body_size:
+            body = None
+        with self._lock:
+            if not etag and not last_modified:
+                self._db.execute(
+                    'DELETE FROM validators WHERE url = ?', (url, ))
+            else:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO validators '
+                    '(url, etag, last_modified, body, expires) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (url, etag, last_modified,
+                     None if body is None else sqlite3.Binary(body),
+                     time.time() + self.ttl))
+            self._db.commit()
+
+
+def _finished(entities):
+    """Check whether all entities are in a final state."""
+    return all(entity.get('state') in FINISHED_STATES for entity in entities)
+
+
+def default_ttl_policy(url, data, ttl):
+    """
+    Get the number of seconds a Travis API response may be reused.
+
+    Finished builds and jobs never change, so are kept forever.
+    A job which has not finished is not kept, as it is polled until it
+    finishes.
+    A page of builds requested with after_number only contains older
+    builds, so it is also kept forever once they are all finished.
+    Everything else, including repositories, uses ttl.
+    """
+    if not isinstance(data, dict):
+        return ttl
+
+    for key in ('build', 'job'):
+        if key in data and _finished([data[key]]):
+            return FOREVER
+
+    if 'job' in data:
+        return 0
+
+    if 'jobs' in data and 'builds' not in data:
+        if data['jobs'] and _finished(data['jobs']):
+            return FOREVER
+
+    if 'builds' in data:
+        query = parse_qs(urlparse(url).query)
+        if 'after_number' in query and _finished(data['builds']):
+            return FOREVER
+
+    return ttl
+
+
+class ResponseCache(object):
+    """
+    Cache of Travis API responses.
+
+    Responses are kept in memory with LRU eviction, and optionally in a
+    SQLite database in the log directory so they can be used by later
+    runs.  The lifetime of each response is decided by policy, which is
+    given the URL, the decoded JSON and the default ttl.  Responses are
+    kept on disk for at most disk_ttl seconds, and expired responses are
+    removed from disk when the cache is opened.
+    """
+
+    filename = '.travis_log_fetch.responses.sqlite'
+
+    def __init__(self, maxsize=1000, ttl=10, base_dir=None,
+                 policy=default_ttl_policy, disk_ttl=DISK_TTL):
+        """Constructor."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.policy = policy
+        self.disk_ttl = disk_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if base_dir:
+            if not os.path.isdir(base_dir):
+                os.makedirs(base_dir)
+            self._db = sqlite3.connect(
+                os.path.join(base_dir, self.filename),
+                check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses '
+                '(url TEXT PRIMARY KEY, expires REAL, body BLOB)')
+            self._db.execute(
+                'DELETE FROM responses WHERE expires IS NULL OR expires < ?',
+                (time.time(), ))
+            self._db.commit()
+
+    def close(self):
+        """Close the database."""
+        if self._db:
+            self._db.close()
+
+    def get(self, url):
+        """Get a stored body of url which has not expired, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is None and self._db:
+                entry = self._db.execute(
+                    'SELECT expires, body FROM responses WHERE url = ?',
+                    (url, )).fetchone()
+                if entry:
+                    entry = (entry[0], bytes(entry[1]))
+
+            if entry is None:
+                return
+
+            expires, body = entry
+            if expires is not FOREVER and expires < now:
+                if self._db:
+                    self._db.execute(
+                        'DELETE FROM responses WHERE url = ?', (url, ))
+                    self._db.commit()
+                return
+
+            self._insert(url, entry)
+            return body
+
+    def _insert(self, url, entry):
+        """Insert an entry in memory, evicting the least recently used."""
+        self._entries[url] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def store(self, url, body):
+        """Store a JSON response body of url."""
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return
+
+        ttl = self.policy(url, data, self.ttl)
+        if not ttl and ttl is not FOREVER:
+            return
+
+        now = time.time()
+        expires = FOREVER if ttl is FOREVER else now + ttl
+        with self._lock:
+            self._insert(url, (expires, body))
+            if self._db:
+                disk_expires = now + self.disk_ttl
+                if expires is not FOREVER:
+                    disk_expires = min(expires, disk_expires)
+                self._db.execute(
+                    'INSERT OR REPLACE INTO responses (url, expires, body) '
+                    'VALUES (?, ?, ?)',
+                    (url, disk_expires, sqlite3.Binary(body)))
+                self._db.commit()
+
+
+class _HostBudget(object):
+    """Token bucket and rate limit quota of one host."""
+
+    def __init__(self, burst):
+        """Constructor."""
+        self.tokens = burst
+        self.last = None
+        self.remaining = None
+        self.reset = None
+
+
+class RateLimiter(object):
+    """
+    Rate limiter shared by all sessions.
+
+    Each host has a token bucket refilled at rate requests per second,
+    holding at most burst tokens; a rate of None does not limit requests.
+
+    The X-RateLimit-Remaining and X-RateLimit-Reset headers of responses
+    track the quota of the host.  Once fewer than reserve requests remain,
+    requests are spread out evenly until the quota is reset, and when it
+    is exhausted requests wait for the reset.  A Retry-After header also
+    pauses the host.
+    """
+
+    def __init__(self, rate=None, burst=1, reserve=50):
+        """Constructor."""
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _get_budget(self, url):
+        """Get the budget of the host of url."""
+        host = urlparse(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = _HostBudget(self.burst)
+        return self._hosts[host]
+
+    def _delay(self, budget, now):
+        """Get the seconds to wait before the next request to a host."""
+        if budget.reset is not None and now >= budget.reset:
+            budget.remaining = budget.reset = None
+
+        delay = 0
+        if budget.remaining is not None:
+            if budget.remaining <= 0:
+                delay = budget.reset - now
+            elif budget.remaining < self.reserve and budget.last:
+                interval = (budget.reset - now) / budget.remaining
+                delay = budget.last + interval - now
+
+        if self.rate:
+            if budget.last:
+                budget.tokens = min(
+                    self.burst,
+                    budget.tokens + (now - budget.last) * self.rate)
+            if budget.tokens < 1:
+                delay = max(delay, (1 - budget.tokens) / self.rate)
+
+        return delay
+
+    def acquire(self, url):
+        """Wait until a request to url may be sent."""
+        while True:
+            with self._lock:
+                budget = self._get_budget(url)
+                now = time.time()
+                delay = self._delay(budget, now)
+                if delay <= 0:
+                    if self.rate:
+                        budget.tokens -= 1
+                    budget.last = now
+                    if budget.remaining is not None:
+                        budget.remaining -= 1
+                    return
+
+            __logs__.debug('waiting {0:.1f}s for rate limit of {1}'.format(
+                delay, urlparse(url).netloc))
+            time.sleep(delay)
+
+    def update(self, url, headers):
+        """Update the quota of the host of url from response headers."""
+        now = time.time()
+        with self._lock:
+            budget = self._get_budget(url)
+            try:
+                if 'X-RateLimit-Remaining' in headers:
+                    budget.remaining = int(headers['X-RateLimit-Remaining'])
+                    budget.reset = float(headers['X-RateLimit-Reset'])
+                if 'Retry-After' in headers:
+                    budget.remaining = 0
+                    budget.reset = now + float(headers['Retry-After'])
+            except (KeyError, ValueError):
+                budget.remaining = budget.reset = None
+
+    def exhausted(self, url):
+        """Check whether the quota of the host of url is exhausted."""
+        with self._lock:
+            budget = self._get_budget(url)
+            return budget.remaining is not None and budget.remaining <= 0
+
+    def remaining(self):
+        """Get the remaining quota of each host, or None when unknown."""
+        with self._lock:
+            return dict((host, budget.remaining)
+                        for host, budget in self._hosts.items())
+
+
+class RateLimitAdapter(HTTPAdapter):
+    """
+    HTTP adapter sending requests through a RateLimiter.
+
+    A response refused because the quota of the host is exhausted is
+    sent again once the quota is reset.
+    """
+
+    def __init__(self, limiter=None, **kwargs):
+        """Constructor."""
+        self.limiter = limiter
+        super(RateLimitAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        """Send a request when the rate limit allows it."""
+        if not self.limiter:
+            return super(RateLimitAdapter, self).send(request, **kwargs)
+
+        while True:
+            self.limiter.acquire(request.url)
+            response = super(RateLimitAdapter, self).send(request, **kwargs)
+            self.limiter.update(request.url, response.headers)
+            if response.status_code not in (403, 429):
+                return response
+            if not self.limiter.exhausted(request.url):
+                return response
+
+            __logs__.warning('rate limit of {0} exceeded'.format(
+                urlparse(request.url).netloc))
+            response.close()
+
+
+class ConditionalAdapter(RateLimitAdapter):
+    """
+    HTTP adapter caching API metadata.
+
+    JSON responses are stored with their validators in a ValidatorCache.
+    A later GET of the same URL is made conditional, and a 304 response
+    is replaced by the stored body.
+
+    JSON responses are also kept in a ResponseCache, which answers
+    repeated GET requests without using the network until they expire,
+    so they do not count against the rate limit.
+    """
+
+    def __init__(self, cache=None, responses=None, **kwargs):
+        """Constructor."""
+        self.cache = cache
+        self.responses = responses
+        super(ConditionalAdapter, self).__init__(**kwargs)
+
+    def _cached_response(self, request, body):
+        """Build a response from a cached body."""
+        response = Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(
+            {'Content-Type': 'application/json'})
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response._content = body
+        response._content_consumed = True
+        return response
+
+    def send(self, request, stream=False, **kwargs):
+        """Send a request, unless the response is cached."""
+        if request.method != 'GET':
+            return super(ConditionalAdapter, self).send(
+                request, stream=stream, **kwargs)
+
+        if self.responses:
+            body = self.responses.get(request.url)
+            if body is not None:
+                __logs__.debug('cached {0}'.format(request.url))
+                return self._cached_response(request, body)
+
+        body = None
+        if self.cache:
+            row = self.cache.get(request.url)
+            body = row[2] if row else None
+            if body is not None:
+                body = bytes(body)
+                for key, value in self.cache.conditional_headers(
+                        request.url).items():
+                    request.headers.setdefault(key, value)
+
+        response = super(ConditionalAdapter, self).send(
+            request, stream=stream, **kwargs)
+
+        is_json = 'json' in response.headers.get('Content-Type', '')
+        if response.status_code == 304 and body is not None:
+            __logs__.debug('not modified {0}'.format(request.url))
+            response.status_code = 200
+            response.reason = 'OK'
+            response._content = body
+            response._content_consumed = True
+        elif response.status_code == 200 and is_json and not stream:
+            body = response.content
+            if self.cache:
+                self.cache.store(request.url, response, body)
+        else:
+            return response
+
+        if self.responses:
+            self.responses.store(request.url, body)
+
+        return response
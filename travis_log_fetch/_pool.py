@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Worker thread pools."""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from collections import deque
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+def _call(func, item):
+    """Call func with item, returning a tuple of success and result."""
+    try:
+        return True, func(item)
+    except Exception as e:
+        return False, e
+
+
+def _unwrap(outcome):
+    """Get the result of _call, raising its exception."""
+    success, result = outcome
+    if not success:
+        raise result
+    return result
+
+
+def imap(func, iterable, workers, ordered=True, window=None):
+    """
+    Map func over iterable using a pool of worker threads, lazily.
+
+    Unlike ThreadPool.imap, which reads all of iterable into its task
+    queue, at most window items are in progress at once; by default
+    twice the number of workers.  Items are taken from iterable in the
+    calling thread, so the pool can be terminated without waiting for it.
+
+    Results are yielded in the order of iterable, unless ordered is False,
+    when they are yielded as they are completed.
+    """
+    window = window or 2 * workers
+    iterator = iter(iterable)
+    pending = deque()
+    completed = Queue()
+    callback = None if ordered else completed.put
+
+    pool = ThreadPool(workers)
+    try:
+        def _submit(items):
+            for item in items:
+                pending.append(pool.apply_async(_call, (func, item),
+                                                callback=callback))
+
+        _submit(islice(iterator, window))
+        while pending:
+            if ordered:
+                outcome = pending.popleft().get()
+            else:
+                outcome = completed.get()
+                pending.pop()
+            _submit(islice(iterator, 1))
+            yield _unwrap(outcome)
+    finally:
+        pool.terminate()
+        pool.join()
@@ -5,153 +5,1045 @@ from __future__ import unicode_literals
 
 import codecs
 import datetime
+import errno
+import hashlib
+import io
 import os
+import sqlite3
+import tempfile
+import threading
+import time
 
+from contextlib import contextmanager
+from functools import partial
 from logging import getLogger
 from os.path import dirname, isdir
 
 import dateutil
 import dateutil.parser
 
-import parse
-
 import requests
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from travis_log_fetch import _compress, _pool
+from travis_log_fetch._filename import _FIELD, _FIELD_PATTERNS, compile_format
+from travis_log_fetch._http import FINISHED_STATES
 from travis_log_fetch._target import Target
+from travis_log_fetch.get import get_build_slug
 
 __logs__ = getLogger(__package__)
 
 _HEADERS = {'Accept': 'text/plain; version=2'}
 
+_CHUNK_SIZE = 64 * 1024
+
+_TEMP_SUFFIX = '.tmp'
+
+# Prefix of metadata files kept in the top of the log directory
+_METADATA_PREFIX = '.travis_log_fetch'
+
+# Directory of log bodies stored by their SHA-256 hash
+_OBJECTS_DIR = _METADATA_PREFIX + '.objects'
+
+# The umask can only be read by setting it, which is not thread safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Temporary files untouched for this many seconds are from a dead process
+_TEMP_MAX_AGE = 60 * 60
+
+# Number of builds sharing a {job.build_bucket} directory
+_BUCKET_SIZE = 1000
+
+# Directories at this depth, usually repos, are scanned concurrently
+_FAN_OUT_DEPTH = 2
+
+_SCAN_WORKERS = 8
+
+
+class StoreIndex(object):
+    """
+    Persistent index of the files stored under a log directory.
+
+    The index is a SQLite database kept in the log directory, recording
+    the mtime of every directory and the files within it.  refresh() only
+    lists directories whose mtime has changed since the previous scan,
+    and download_job_log adds each file it writes.
+    """
+
+    filename = _METADATA_PREFIX + '.sqlite'
+
+    def __init__(self, base_dir):
+        """Open or create the index of base_dir."""
+        if not isdir(base_dir):
+            os.makedirs(base_dir)
+
+        self.base_dir = base_dir
+        self._db = sqlite3.connect(os.path.join(base_dir, self.filename),
+                                   check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS dirs '
+            '(path TEXT PRIMARY KEY, parent TEXT, mtime REAL)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS files '
+            '(dir TEXT, name TEXT, mtime REAL, PRIMARY KEY (dir, name))')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS temp_files '
+            '(dir TEXT, name TEXT, PRIMARY KEY (dir, name))')
+        self._db.commit()
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
+
+    def refresh(self):
+        """Rescan directories which have changed since the last scan."""
+        self._refresh_dir('', None)
+        self._db.commit()
+
+    def _refresh_dir(self, path, parent):
+        """Refresh one directory, and recurse into its subdirectories."""
+        full_path = os.path.join(self.base_dir, path)
+        mtime = os.stat(full_path).st_mtime
+
+        row = self._db.execute(
+            'SELECT mtime FROM dirs WHERE path = ?', (path, )).fetchone()
+
+        if row and row[0] == mtime:
+            subdirs = [subdir for subdir, in self._db.execute(
+                'SELECT path FROM dirs WHERE parent = ?', (path, ))]
+        else:
+            __logs__.debug('indexing {0}'.format(full_path))
+            subdirs = []
+            files = []
+            temp_files = []
+            for name in os.listdir(full_path):
+                if not path and name.startswith(_METADATA_PREFIX):
+                    continue
+                if _is_temp_file(name):
+                    temp_files.append((path, name))
+                    continue
+                name_path = os.path.join(full_path, name)
+                if isdir(name_path):
+                    subdirs.append(os.path.join(path, name))
+                else:
+                    files.append((path, name, os.lstat(name_path).st_mtime))
+
+            for old_subdir, in self._db.execute(
+                    'SELECT path FROM dirs WHERE parent = ?',
+                    (path, )).fetchall():
+                if old_subdir not in subdirs:
+                    self._forget_dir(old_subdir)
+
+            self._db.execute('DELETE FROM files WHERE dir = ?', (path, ))
+            self._db.executemany(
+                'INSERT INTO files (dir, name, mtime) VALUES (?, ?, ?)',
+                files)
+            self._db.execute('DELETE FROM temp_files WHERE dir = ?', (path, ))
+            self._db.executemany(
+                'INSERT INTO temp_files (dir, name) VALUES (?, ?)',
+                temp_files)
+
+        for subdir in subdirs:
+            self._refresh_dir(subdir, path)
+
+        # The mtime is only recorded after the subdirectories are complete,
+        # so an interrupted scan is resumed on the next refresh.
+        self._db.execute(
+            'INSERT OR REPLACE INTO dirs (path, parent, mtime) '
+            'VALUES (?, ?, ?)', (path, parent, mtime))
+
+    def _forget_dir(self, path):
+        """Remove a deleted directory and its contents from the index."""
+        for subdir, in self._db.execute(
+                'SELECT path FROM dirs WHERE parent = ?', (path, )).fetchall():
+            self._forget_dir(subdir)
+        self._db.execute('DELETE FROM files WHERE dir = ?', (path, ))
+        self._db.execute('DELETE FROM temp_files WHERE dir = ?', (path, ))
+        self._db.execute('DELETE FROM dirs WHERE path = ?', (path, ))
+
+    def add(self, filename):
+        """Add or update a file, relative to base_dir."""
+        path, name = os.path.split(filename)
+        mtime = os.lstat(os.path.join(self.base_dir, filename)).st_mtime
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO files (dir, name, mtime) '
+                'VALUES (?, ?, ?)', (path, name, mtime))
+            self._db.commit()
+
+    def get_files(self):
+        """Get list of all indexed files."""
+        with self._lock:
+            return [os.path.join(path, name)
+                    for path, name in self._db.execute(
+                        'SELECT dir, name FROM files ORDER BY dir, name')]
+
+    def remove(self, filenames):
+        """Forget files, relative to base_dir."""
+        with self._lock:
+            self._db.executemany(
+                'DELETE FROM files WHERE dir = ? AND name = ?',
+                [os.path.split(filename) for filename in filenames])
+            self._db.commit()
+
+    def get_file_mtimes(self):
+        """Get list of tuples of each indexed file and its mtime."""
+        with self._lock:
+            return [(os.path.join(path, name), mtime)
+                    for path, name, mtime in self._db.execute(
+                        'SELECT dir, name, mtime FROM files '
+                        'ORDER BY dir, name')]
+
+    def get_temp_files(self):
+        """Get list of temporary files seen by the last refresh."""
+        with self._lock:
+            return [os.path.join(path, name)
+                    for path, name in self._db.execute(
+                        'SELECT dir, name FROM temp_files')]
+
+    def remove_temp_file(self, filename):
+        """Forget a temporary file."""
+        path, name = os.path.split(filename)
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM temp_files WHERE dir = ? AND name = ?',
+                (path, name))
+            self._db.commit()
+
+    def get_dirs(self, depth):
+        """Get list of indexed directories at depth."""
+        with self._lock:
+            return [path for path, in self._db.execute(
+                    'SELECT path FROM dirs ORDER BY path')
+                    if path and len(path.split(os.sep)) == depth]
+
+
+class _FormatJob(object):
+    """
+    Job proxy adding the sharding fields of log filename formats.
+
+    {job.build_bucket} is the build number rounded down to a multiple of
+    _BUCKET_SIZE, so each bucket directory holds the logs of at most
+    _BUCKET_SIZE builds.
+    """
+
+    def __init__(self, job):
+        """Constructor."""
+        self._job = job
+
+    def __getattr__(self, name):
+        """Get an attribute of the job."""
+        return getattr(self._job, name)
+
+    @property
+    def build_bucket(self):
+        """Get the bucket of the build number."""
+        build_number = int(self._job.number.split('.')[0])
+        return build_number // _BUCKET_SIZE * _BUCKET_SIZE
+
+
+class _StoredJob(object):
+    """Job with the fields parsed from a stored log filename."""
+
+    def __init__(self, log):
+        """Constructor."""
+        self.slug = log.slug
+        self.number = '{0}.{1}'.format(log.build_number, log.job_number)
+        self.state = log.state
+
+    @property
+    def repository(self):
+        """Get the repository, which only has a slug."""
+        return self
+
+
+def format_log_filename(log_filename_format, job):
+    """Get the filename of a job log, relative to the log directory."""
+    return log_filename_format.format(job=_FormatJob(job))
+
+
+class _DirEntry(object):
+    """Directory entry for Python versions without scandir."""
+
+    def __init__(self, directory, name):
+        """Constructor."""
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stats = {}
+
+    def is_dir(self):
+        """Check whether the entry is a directory."""
+        return isdir(self.path)
+
+    def is_symlink(self):
+        """Check whether the entry is a symbolic link."""
+        return os.path.islink(self.path)
+
+    def stat(self, follow_symlinks=True):
+        """Get the stat of the entry, which is cached."""
+        if follow_symlinks not in self._stats:
+            stat = os.stat if follow_symlinks else os.lstat
+            self._stats[follow_symlinks] = stat(self.path)
+        return self._stats[follow_symlinks]
+
+
+def _scandir(directory):
+    """Iterate over the entries of directory."""
+    if scandir:
+        return scandir(directory)
+    return (_DirEntry(directory, name) for name in os.listdir(directory))
+
+
+def _is_real_dir(entry):
+    """Check whether an entry is a directory, and not a symbolic link."""
+    # Symbolic links to directories are not followed, like os.walk
+    return entry.is_dir() and not entry.is_symlink()
+
+
+def _scan_tree(base_dir, path, max_depth, include_dirs):
+    """Scan a directory relative to base_dir, and its subdirectories."""
+    depth = len(path.split(os.sep)) + 1 if path else 1
+    try:
+        entries = _scandir(os.path.join(base_dir, path))
+    except OSError:
+        # Removed during the scan, or base_dir does not exist, like os.walk
+        return
+
+    for entry in entries:
+        if not path and entry.name.startswith(_METADATA_PREFIX):
+            continue
+        relative_path = os.path.join(path, entry.name)
+        if _is_real_dir(entry):
+            if include_dirs:
+                yield relative_path, entry
+            if max_depth is None or depth < max_depth:
+                for item in _scan_tree(base_dir, relative_path, max_depth,
+                                       include_dirs):
+                    yield item
+        else:
+            yield relative_path, entry
+
+
+def _scan_subtree(base_dir, max_depth, include_dirs, path):
+    """Get the entries under one directory."""
+    return list(_scan_tree(base_dir, path, max_depth, include_dirs))
+
+
+def scan(base_dir, max_depth=None, include_dirs=False,
+         workers=_SCAN_WORKERS):
+    """
+    Iterate over the entries under base_dir lazily.
+
+    Each item is a tuple of the path relative to base_dir and the entry,
+    which caches its stat data.  Directories at max_depth are not
+    entered, and directories are only included with include_dirs.
+    Metadata in the top of base_dir is skipped.
+
+    Directories at _FAN_OUT_DEPTH are scanned by a pool of workers, in
+    order, each while the entries of previous directories are consumed.
+    """
+    shallow = max_depth is not None and max_depth <= _FAN_OUT_DEPTH
+    if workers <= 1 or shallow:
+        for item in _scan_tree(base_dir, '', max_depth, include_dirs):
+            yield item
+        return
 
-# TODO: add a 'clean' function to delete all logs which are
-# associated with incomplete jobs.
+    subtrees = []
+    for relative_path, entry in _scan_tree(base_dir, '', _FAN_OUT_DEPTH,
+                                           True):
+        is_dir = _is_real_dir(entry)
+        if is_dir and len(relative_path.split(os.sep)) == _FAN_OUT_DEPTH:
+            subtrees.append(relative_path)
+        if include_dirs or not is_dir:
+            yield relative_path, entry
 
-# Create a new class to cache the stored metadata.
+    # Only a window of subtrees is scanned ahead of the consumer
+    for items in _pool.imap(
+            partial(_scan_subtree, base_dir, max_depth, include_dirs),
+            subtrees, workers):
+        for item in items:
+            yield item
 
 
-def get_files(base_dir):
+def _scan_files(base_dir, temp_files=None):
+    """
+    Iterate over the files under base_dir, and their entries.
+
+    Temporary files are skipped, and appended to temp_files if given.
+    """
+    for filename, entry in scan(base_dir):
+        if not _is_temp_file(entry.name):
+            yield filename, entry
+        elif temp_files is not None:
+            temp_files.append(filename)
+
+
+def get_files(base_dir, index=None, temp_files=None):
     """Get list of all files under base_dir."""
-    filenames = []
-    for root, dirs, files in os.walk(base_dir):
-        for file in files:
-            filenames.append(os.path.join(root[len(base_dir):], file))
+    if index:
+        return index.get_files()
+
+    return [filename for filename, entry in _scan_files(base_dir, temp_files)]
+
+
+def get_file_mtimes(base_dir, index=None, temp_files=None):
+    """
+    Get list of tuples of each file under base_dir and its mtime.
+
+    The mtime of a symbolic link to a deduplicated log is its own.
+    """
+    if index:
+        return index.get_file_mtimes()
+
+    return [(filename, entry.stat(follow_symlinks=False).st_mtime)
+            for filename, entry in _scan_files(base_dir, temp_files)]
 
-    return filenames
 
+def _parse_filename(parser, filename):
+    """Parse a stored log filename into a StoredLog, or None."""
+    log = parser(_compress.strip_extension(filename))
+    if not log:
+        __logs__.warning('Unexpected filename {0}'.format(filename))
+    return log
 
-def get_stored_targets(base_dir, log_filename_format=None):
+
+def _stored_log_target(log):
+    """Convert a StoredLog into a Target."""
+    target = Target(slug=log.slug, build_number=log.build_number,
+                    job_number=log.job_number)
+    target.state = log.state
+    return target
+
+
+def get_stored_targets(base_dir, log_filename_format=None, index=None):
     """Get parsed stored targets."""
-    assert log_filename_format
-    if '{job.state}' in log_filename_format:
-        log_filename_format = log_filename_format.replace(
-            '{job.state}', '{job.state:w}')
+    return [_stored_log_target(log)
+            for log in _get_stored_logs(base_dir, log_filename_format, index)]
 
-    if '{job.number}' in log_filename_format:
-        log_filename_format = log_filename_format.replace(
-            '{job.number}', '{job.number:f}')
 
-    parser = parse.compile(log_filename_format)
+def _get_stored_logs(base_dir, log_filename_format, index=None,
+                     temp_files=None):
+    """Get a StoredLog tuple of each stored log."""
+    assert log_filename_format
+    parser = compile_format(log_filename_format)
 
     if base_dir[-1] != '/':
         base_dir = base_dir + '/'
 
-    filenames = get_files(base_dir)
+    logs = []
+    for filename in get_files(base_dir, index, temp_files):
+        log = _parse_filename(parser, filename)
+        if log:
+            logs.append(log)
+
+    return logs
+
+
+def _get_stored_job_mtimes(base_dir, log_filename_format, index=None,
+                           temp_files=None):
+    """
+    Get the mtime of the stored logs of each build.
 
-    targets = []
-    for filename in filenames:
-        parsed_filename = parser.parse(filename)
-        if not parsed_filename:
-            __logs__.warning('Unexpected filename {0}'.format(filename))
+    The result maps slug and build number to a dict of the newest mtime
+    of each job number.
+    """
+    parser = compile_format(log_filename_format)
+
+    if base_dir[-1] != '/':
+        base_dir = base_dir + '/'
+
+    builds = {}
+    for filename, mtime in get_file_mtimes(base_dir, index, temp_files):
+        log = _parse_filename(parser, filename)
+        if not log or not log.slug or not log.build_number:
             continue
-        target = Target()
-        try:
-            target.slug = parsed_filename['job.repository.slug']
-        except KeyError:
-            pass
-        try:
-            target.number = str(parsed_filename['job.number'])
-        except KeyError:
-            pass
-        try:
-            target.state = parsed_filename['job.state']
-        except KeyError:
-            pass
+        jobs = builds.setdefault((log.slug, log.build_number), {})
+        jobs[log.job_number] = max(mtime, jobs.get(log.job_number, 0))
 
-        targets.append(target)
+    return builds
+
+
+def _is_fresh_build(build, stored_jobs):
+    """Check whether a log of every job of a finished build is up to date."""
+    finished_at = getattr(build, 'finished_at', None)
+    job_ids = getattr(build, 'job_ids', None)
+    if not finished_at or not job_ids:
+        return False
+
+    jobs = stored_jobs.get((get_build_slug(build), int(build.number)))
+    if not jobs or len(jobs) < len(job_ids):
+        return False
 
-    return targets
+    build_finish_ts = dateutil.parser.parse(finished_at)
+    oldest_ts = datetime.datetime.fromtimestamp(min(jobs.values()),
+                                                dateutil.tz.tzutc())
+    return oldest_ts >= build_finish_ts
+
+
+def iter_skip_fresh(builds, base_dir, log_filename_format=None, index=None,
+                    sweep=False):
+    """
+    Skip finished builds with every job log stored after it finished.
+
+    Only travispy builds are checked, as they include the finish time
+    and job ids, so their jobs are not loaded.  Other targets are kept.
+    With sweep, orphaned temporary files are removed, as by
+    remove_temp_files, using the same scan of base_dir.
+    """
+    assert log_filename_format
+    temp_files = None if index else []
+    stored_jobs = _get_stored_job_mtimes(base_dir, log_filename_format,
+                                         index, temp_files)
+    if sweep:
+        remove_temp_files(base_dir, index, temp_files=temp_files)
+
+    for build in builds:
+        if _is_fresh_build(build, stored_jobs):
+            __logs__.info('skipping up to date build {0}'.format(
+                build.number))
+        else:
+            yield build
+
+
+def _group_stored_builds(logs):
+    """Group the build numbers of stored logs or targets by repo slug."""
+    builds = {}
+    for log in logs:
+        builds.setdefault(log.slug, set()).add(log.build_number)
+    return builds
 
 
 def _select_repo_builds(targets, slug):
     """Filter targets for one repo."""
-    targets = [target for target in targets if target.slug == slug]
-    build_numbers = set(target.build_number for target in targets
-                        if isinstance(target, Target))
+    build_numbers = _group_stored_builds(targets).get(slug, ())
     builds = [Target(slug=slug, build_number=build_number)
               for build_number in build_numbers]
     return builds
 
 
-def get_repo_stored_builds(base_dir, slug, log_filename_format=None):
+def get_repo_stored_builds(base_dir, slug, log_filename_format=None,
+                           index=None):
     """Get stored builds for a repo."""
-    targets = get_stored_targets(base_dir, log_filename_format)
+    targets = get_stored_targets(base_dir, log_filename_format, index)
     builds = _select_repo_builds(targets, slug)
     return builds
 
 
-def skip_stored(targets, base_dir, log_filename_format=None):
-    """Optimistically skip targets that have been fetched."""
+def _is_stored_build(target, stored_builds):
+    """Check whether target is a build with stored logs."""
+    if not target.build_number or target.job_number:
+        return False
+    return target.build_number in stored_builds.get(target.slug, ())
+
+
+def iter_skip_stored(targets, base_dir, log_filename_format=None,
+                     index=None, sweep=False):
+    """
+    Optimistically skip targets that have been fetched, lazily.
+
+    With sweep, orphaned temporary files are removed, as by
+    remove_temp_files, using the same scan of base_dir.
+    """
     assert log_filename_format
-    stored_targets = get_stored_targets(base_dir, log_filename_format)
+    temp_files = None if index else []
+    stored_builds = _group_stored_builds(
+        _get_stored_logs(base_dir, log_filename_format, index, temp_files))
+    if sweep:
+        remove_temp_files(base_dir, index, temp_files=temp_files)
 
-    new_targets = []
     for target in targets:
         if not isinstance(target, Target):
             target = Target._from_travispy_obj(target)
 
-        slug = target.slug
-
-        stored_repo_targets = _select_repo_builds(stored_targets, slug)
-        if target not in stored_repo_targets:
-            __logs__.debug('target {0} not found in {1!r}'.format(
-                target, stored_repo_targets))
-            new_targets.append(target)
+        if not _is_stored_build(target, stored_builds):
+            __logs__.debug('target {0} not found in stored builds'.format(
+                target))
+            yield target
         else:
             __logs__.info('skipping existing {0}'.format(target))
 
-    return new_targets
+
+def skip_stored(targets, base_dir, log_filename_format=None, index=None):
+    """Optimistically skip targets that have been fetched."""
+    return list(iter_skip_stored(targets, base_dir, log_filename_format,
+                                 index))
 
 
-def _get_simple_stored_repo_slugs(base_dir):
+def _get_simple_stored_repo_slugs(base_dir, index=None):
     """Get repo slugs from first two directory names."""
-    if base_dir[-1] != '/':
-        base_dir = base_dir + '/'
+    if index:
+        return index.get_dirs(2)
 
-    slugs = [root[len(base_dir):] for root, dirs, files in os.walk(base_dir)
-             if len(root[len(base_dir):].split(os.sep)) == 2]
+    slugs = [path for path, entry in scan(base_dir, 2, include_dirs=True)
+             if _is_real_dir(entry) and len(path.split(os.sep)) == 2]
 
     return slugs
 
 
-def get_stored_repo_slugs(base_dir, log_filename_format=None):
+def get_stored_repo_slugs(base_dir, log_filename_format=None, index=None):
     """Get existing directory slugs."""
     assert log_filename_format
     if log_filename_format.startswith('{job.repository.slug}/'):
-        return _get_simple_stored_repo_slugs(base_dir)
+        return _get_simple_stored_repo_slugs(base_dir, index)
 
-    targets = get_stored_targets(base_dir, log_filename_format)
-    slugs = set(target.slug for target in targets)
+    logs = _get_stored_logs(base_dir, log_filename_format, index)
+    slugs = set(log.slug for log in logs)
     return slugs
 
 
-def download_job_log(base_dir, job, log_filename_format=None):
+def new_log_session():
+    """Create a keep-alive session for fetching logs directly."""
+    session = requests.Session()
+    session.headers.update(_HEADERS)
+    return session
+
+
+def _job_log_url(job):
+    """Get the URL to fetch a job log directly."""
+    return '%s/jobs/%s/log' % (job._session.uri, job.id)
+
+
+def _is_temp_file(name):
+    """Check whether a filename is a temporary file of this module."""
+    name = os.path.basename(name)
+    return name.startswith('.') and name.endswith(_TEMP_SUFFIX)
+
+
+def _replace(source, destination):
+    """Atomically rename source to destination."""
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    elif os.name == 'nt':
+        # Python 2 on Windows can not rename over an existing file
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+    else:
+        os.rename(source, destination)
+
+
+def _mkstemp(filename):
+    """
+    Create a temporary file next to filename, for replacing it.
+
+    mkstemp creates files only readable by the owner, so the temporary
+    file is given the mode of filename, or the default mode of new files.
+    """
+    fd, temp_filename = tempfile.mkstemp(
+        dir=dirname(filename),
+        prefix='.{0}.'.format(os.path.basename(filename)),
+        suffix=_TEMP_SUFFIX)
+    try:
+        mode = os.stat(filename).st_mode & 0o7777
+    except OSError:
+        mode = 0o666 & ~_UMASK
+    os.chmod(temp_filename, mode)
+    return fd, temp_filename
+
+
+@contextmanager
+def _atomic_open(filename, compression=None):
+    """
+    Open a temporary file which replaces filename when closed.
+
+    The temporary file is in the same directory as filename, and is
+    synced to disk before it is renamed, so filename is never seen with
+    partial contents.  The temporary file is removed on error.
+    """
+    fd, temp_filename = _mkstemp(filename)
+    try:
+        with io.open(fd, 'wb') as raw:
+            if compression:
+                stream = _compress.compressor(raw, compression)
+            else:
+                stream = raw
+            f = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+            try:
+                yield f
+                f.flush()
+            finally:
+                f.detach()
+            if stream is not raw:
+                stream.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+        _replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def _temp_filename(filename):
+    """Get an unused temporary filename next to filename."""
+    fd, temp_filename = _mkstemp(filename)
+    os.close(fd)
+    os.remove(temp_filename)
+    return temp_filename
+
+
+def _hash_file(filename):
+    """Get the SHA-256 hex digest of the contents of filename."""
+    digest = hashlib.sha256()
+    with io.open(filename, 'rb') as f:
+        for chunk in iter(partial(f.read, _CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link_target(filename):
+    """Get the path of the file linked by the symbolic link filename."""
+    return os.path.join(dirname(filename), os.readlink(filename))
+
+
+def _symlink(source, filename):
+    """Atomically replace filename with a relative symbolic link to source."""
+    temp_filename = _temp_filename(filename)
+    os.symlink(os.path.relpath(source, dirname(filename)), temp_filename)
+    try:
+        _replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def _touch(filename):
+    """Mark a stored log as up to date, without changing other logs."""
+    if os.path.islink(filename):
+        _symlink(_link_target(filename), filename)
+    else:
+        os.utime(filename, None)
+
+
+def _dedup(base_dir, filename):
+    """
+    Share the contents of filename with identical stored logs.
+
+    The first log with some contents is hardlinked into the objects
+    directory under its hash, and later identical logs are replaced by
+    a symbolic link to that object.  Each symbolic link has its own mtime,
+    so the logs sharing an object are each up to date separately.  The
+    log is kept as a regular file when links are not supported.
+    Returns True if filename is linked.
+    """
+    if not hasattr(os, 'link') or not hasattr(os, 'symlink'):
+        return False
+
+    digest = _hash_file(filename)
+    object_filename = os.path.join(base_dir, _OBJECTS_DIR, digest[:2],
+                                   digest[2:])
+    directory_name = dirname(object_filename)
+    if not isdir(directory_name):
+        _makedirs(directory_name)
+
+    try:
+        os.link(filename, object_filename)
+        return True
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            __logs__.warning('unable to link {0}: {1}'.format(filename, e))
+            return False
+
+    try:
+        _symlink(object_filename, filename)
+    except OSError as e:
+        __logs__.warning('unable to link {0}: {1}'.format(filename, e))
+        return False
+
+    __logs__.debug('{0} is identical to {1}'.format(filename, digest))
+    return True
+
+
+def _get_linked_objects(base_dir):
+    """Get the set of absolute paths linked by logs under base_dir."""
+    return set(os.path.abspath(_link_target(entry.path))
+               for path, entry in scan(base_dir) if entry.is_symlink())
+
+
+def _remove_orphaned_objects(base_dir, dry_run=False):
+    """
+    Remove stored objects which are no longer linked to any log.
+
+    Objects without another hardlink are only kept if a symbolic link
+    under base_dir refers to them.
+    """
+    objects_dir = os.path.join(base_dir, _OBJECTS_DIR)
+    unlinked = []
+    for path, entry in scan(objects_dir):
+        if not _is_temp_file(entry.name) and entry.stat().st_nlink == 1:
+            unlinked.append(entry.path)
+    if unlinked:
+        linked = _get_linked_objects(base_dir)
+        unlinked = [filename for filename in unlinked
+                    if os.path.abspath(filename) not in linked]
+
+    for filename in unlinked:
+        if not dry_run:
+            os.remove(filename)
+
+    count = len(unlinked)
+    if count:
+        __logs__.info('{0} {1} orphaned objects'.format(
+            'found' if dry_run else 'removed', count))
+    return count
+
+
+def _get_temp_files(base_dir, index=None):
+    """Get temporary files under base_dir, relative to base_dir."""
+    if index:
+        return index.get_temp_files()
+
+    return [filename for filename, entry in scan(base_dir)
+            if _is_temp_file(entry.name)]
+
+
+def remove_temp_files(base_dir, index=None, max_age=_TEMP_MAX_AGE,
+                      temp_files=None):
+    """
+    Remove temporary files left behind by interrupted downloads.
+
+    Only files which have not been modified for max_age seconds are
+    removed, so that downloads of concurrent processes are not disturbed.
+    temp_files may be the temporary files already found under base_dir.
+    """
+    if temp_files is None:
+        temp_files = _get_temp_files(base_dir, index)
+
+    expiry = time.time() - max_age
+    count = 0
+    for temp_filename in temp_files:
+        filename = os.path.join(base_dir, temp_filename)
+        try:
+            if os.stat(filename).st_mtime >= expiry:
+                continue
+            os.remove(filename)
+            count += 1
+        except OSError as e:
+            # Completed or removed by another process
+            if e.errno != errno.ENOENT:
+                raise
+        if index:
+            index.remove_temp_file(temp_filename)
+
+    if count:
+        __logs__.info('removed {0} orphaned temporary files'.format(count))
+    return count
+
+
+def get_superseded_logs(base_dir, log_filename_format=None, index=None):
+    """
+    Get stored logs superseded by a final state log of the same job.
+
+    Stored files are grouped by slug and job number.  The newest log in a
+    final state supersedes the other logs of the job, except logs written
+    after it by a restarted job.  Jobs without a log in a final state are
+    kept, as they may still be running.
+    """
+    assert log_filename_format
+    parser = compile_format(log_filename_format)
+
+    if base_dir[-1] != '/':
+        base_dir = base_dir + '/'
+
+    jobs = {}
+    for filename, mtime in get_file_mtimes(base_dir, index):
+        log = _parse_filename(parser, filename)
+        if not log or not log.job_number or not log.state:
+            continue
+        key = (log.slug, log.build_number, log.job_number)
+        jobs.setdefault(key, []).append(
+            (mtime, log.state in FINISHED_STATES, filename))
+
+    superseded = []
+    for logs in jobs.values():
+        final_logs = [log for log in logs if log[1]]
+        if not final_logs:
+            continue
+        newest = max(final_logs)
+        for mtime, finished, filename in logs:
+            if filename == newest[2]:
+                continue
+            # Logs written after the newest final log are from a restart
+            if finished or mtime <= newest[0]:
+                superseded.append(filename)
+
+    return sorted(superseded)
+
+
+def clean(base_dir, log_filename_format=None, index=None, dry_run=False):
+    """
+    Delete stored logs superseded by a final state log of the same job.
+
+    Objects of deduplicated logs which are no longer used are also
+    removed.  With dry_run, the logs are only reported.
+    Returns the list of superseded logs.
+    """
+    superseded = get_superseded_logs(base_dir, log_filename_format, index)
+
+    size = 0
+    for filename in superseded:
+        full_filename = os.path.join(base_dir, filename)
+        size += os.lstat(full_filename).st_size
+        if dry_run:
+            __logs__.info('would delete {0}'.format(full_filename))
+        else:
+            os.remove(full_filename)
+            __logs__.debug('deleted {0}'.format(full_filename))
+
+    if index and not dry_run:
+        index.remove(superseded)
+
+    __logs__.info('{0} {1} superseded logs of {2} bytes'.format(
+        'found' if dry_run else 'deleted', len(superseded), size))
+
+    _remove_orphaned_objects(base_dir, dry_run)
+    return superseded
+
+
+def _remove_empty_dirs(base_dir, path):
+    """Remove path and its parents, while empty, up to base_dir."""
+    while path:
+        try:
+            os.rmdir(os.path.join(base_dir, path))
+        except OSError:
+            return
+        path = dirname(path)
+
+
+def _check_parsed_fields(log_filename_format):
+    """Raise ValueError if a format has fields not parsed from filenames."""
+    for match in _FIELD.finditer(log_filename_format):
+        if match.group(1) not in _FIELD_PATTERNS:
+            raise ValueError(
+                'field {{{0}}} of {1} can not be parsed from filenames'.format(
+                    match.group(1), log_filename_format))
+
+
+def reshard(base_dir, old_log_filename_format, log_filename_format,
+            index=None, dry_run=False):
+    """
+    Move stored logs from one filename format to another.
+
+    Only the fields which can be parsed from filenames may be used, which
+    are {job.repository.slug}, {job.number}, {job.state} and
+    {job.build_bucket}; ValueError is raised before any log is moved if
+    either format has other fields.  Logs which can not be moved exactly
+    are kept.  With dry_run, the moves are only reported.
+    Returns the number of logs moved.
+    """
+    assert old_log_filename_format and log_filename_format
+    _check_parsed_fields(old_log_filename_format)
+    _check_parsed_fields(log_filename_format)
+    parser = compile_format(old_log_filename_format)
+
+    if base_dir[-1] != '/':
+        base_dir = base_dir + '/'
+
+    count = 0
+    for filename in get_files(base_dir, index):
+        stripped_filename = _compress.strip_extension(filename)
+        log = _parse_filename(parser, stripped_filename)
+        if not log or not log.job_number:
+            continue
+
+        job = _StoredJob(log)
+        if format_log_filename(old_log_filename_format,
+                               job) != stripped_filename:
+            __logs__.warning('Unable to reshard {0}'.format(filename))
+            continue
+
+        extension = filename[len(stripped_filename):]
+        new_filename = format_log_filename(log_filename_format, job)
+        new_filename += extension
+        if new_filename == filename:
+            continue
+        if os.path.exists(os.path.join(base_dir, new_filename)):
+            __logs__.warning('Not replacing {0} with {1}'.format(
+                new_filename, filename))
+            continue
+
+        count += 1
+        if dry_run:
+            __logs__.info('would move {0} to {1}'.format(
+                filename, new_filename))
+            continue
+
+        full_filename = os.path.join(base_dir, filename)
+        full_new_filename = os.path.join(base_dir, new_filename)
+        directory_name = dirname(full_new_filename)
+        if not isdir(directory_name):
+            _makedirs(directory_name)
+        if os.path.islink(full_filename):
+            # Links to objects are relative, so are created again
+            _symlink(_link_target(full_filename), full_new_filename)
+            os.remove(full_filename)
+        else:
+            _replace(full_filename, full_new_filename)
+        _remove_empty_dirs(base_dir, dirname(filename))
+        __logs__.debug('moved {0} to {1}'.format(filename, new_filename))
+
+    if index and not dry_run:
+        index.refresh()
+
+    __logs__.info('{0} {1} logs'.format(
+        'would move' if dry_run else 'moved', count))
+    return count
+
+
+def _makedirs(directory_name):
+    """Create a directory, allowing it to be created concurrently."""
+    try:
+        os.makedirs(directory_name)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not isdir(directory_name):
+            raise
+
+
+def _stream_job_log(r, filename, compression=None):
+    """
+    Stream a job log response into filename.
+
+    The log is decoded incrementally while being written.
+    Returns the number of characters written.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    length = 0
+
+    try:
+        with _atomic_open(filename, compression) as f:
+            for chunk in r.iter_content(_CHUNK_SIZE):
+                text = decoder.decode(chunk)
+                length += len(text)
+                f.write(text)
+            text = decoder.decode(b'', final=True)
+            length += len(text)
+            f.write(text)
+    finally:
+        r.close()
+
+    return length
+
+
+def download_job_log(base_dir, job, log_filename_format=None, index=None,
+                     session=None, stream=False, compression=None,
+                     validators=None, dedup=False):
     """Download job log."""
-    filename = log_filename_format.format(job=job)
-    filename = '{0}/{1}'.format(base_dir, filename)
+    relative_filename = format_log_filename(log_filename_format, job)
+    if compression:
+        relative_filename += _compress.EXTENSIONS[compression]
+    filename = '{0}/{1}'.format(base_dir, relative_filename)
 
-    if job.finished_at and os.path.exists(filename):
-        file_ts = os.stat(filename).st_mtime
+    exists = os.path.exists(filename)
+    if job.finished_at and exists:
+        file_ts = os.lstat(filename).st_mtime
         file_ts = datetime.datetime.fromtimestamp(file_ts, dateutil.tz.tzutc())
         job_finish_ts = dateutil.parser.parse(job.finished_at)
         if file_ts >= job_finish_ts:
@@ -159,25 +1051,92 @@ def download_job_log(base_dir, job, log_filename_format=None):
 
     directory_name = dirname(filename)
     if not isdir(directory_name):
-        os.makedirs(directory_name)
+        _makedirs(directory_name)
 
-    text = job.log.body
+    if not session:
+        session = new_log_session()
 
-    # FIXME(upstream): https://github.com/menegazzo/travispy/pull/27
-    if not text:
+    url = _job_log_url(job)
+
+    # Validators are only useful when the stored log can be kept
+    headers = {}
+    if validators and exists:
+        headers = validators.conditional_headers(url)
+
+    # Logs are fetched through the session to store their validators
+    r = None
+    if stream or validators:
         __logs__.info('fetching job {0} log directly'.format(job.id))
-        r = requests.get('%s/jobs/%s/log' % (job._session.uri, job.id),
-                         headers=_HEADERS)
-        text = r.content.decode('utf-8')
+        r = session.get(url, stream=stream, headers=headers)
+        if r.status_code == 304:
+            r.close()
+            # Mark the stored log as up to date
+            _touch(filename)
+            if index:
+                index.add(relative_filename)
+            __logs__.info('unchanged {0}'.format(filename))
+            return
+        r.raise_for_status()
+
+    if stream:
+        length = _stream_job_log(r, filename, compression)
+    else:
+        text = r.content.decode('utf-8') if r else job.log.body
+
+        # FIXME(upstream): https://github.com/menegazzo/travispy/pull/27
+        if not text:
+            __logs__.info('fetching job {0} log directly'.format(job.id))
+            r = session.get(url)
+            text = r.content.decode('utf-8')
+
+        try:
+            with _atomic_open(filename, compression) as f:
+                f.write(text)
+        except (UnicodeDecodeError, TypeError) as e:
+            __logs__.warning(
+                '{0} while storing {1} into {2}: {3}'.format(
+                    e.__class__.__name__, type(text), filename, e))
+            raise
+
+        length = len(text)
+
+    if validators and r is not None:
+        validators.store(url, r)
+
+    if dedup:
+        _dedup(base_dir, filename)
+
+    if index:
+        index.add(relative_filename)
+
+    __logs__.info('wrote {0} with {1} chars'.format(filename, length))
+
+
+def download_job_logs(base_dir, jobs, log_filename_format=None, index=None,
+                      workers=1, session=None, stream=False,
+                      compression=None, validators=None, dedup=False):
+    """Download job logs using a pool of worker threads."""
+    if not session:
+        session = new_log_session()
+
+    if workers <= 1:
+        for job in jobs:
+            download_job_log(base_dir, job, log_filename_format, index,
+                             session, stream, compression, validators, dedup)
+        return
+
+    def _download(job):
+        __logs__.debug('{0} downloading job {1}'.format(
+            threading.current_thread().name, job.id))
+        download_job_log(base_dir, job, log_filename_format, index, session,
+                         stream, compression, validators, dedup)
+        return job
 
     try:
-        with codecs.open(filename, 'w', 'utf8') as f:
-            f.write(text)
-    except UnicodeDecodeError as e:
-        __logs__.warning(
-            'UnicodeDecodeError while storing {0} into {1}: {2}'.format(
-                type(text), filename, e))
-        os.remove(filename)
+        for count, job in enumerate(
+                _pool.imap(_download, jobs, workers, ordered=False), 1):
+            __logs__.info('downloaded {0} logs; last job {1}'.format(
+                count, job.id))
+    except BaseException:
+        __logs__.error('stopping {0} download workers'.format(workers))
         raise
-
-    __logs__.info('wrote {0} with {1} chars'.format(filename, len(text)))
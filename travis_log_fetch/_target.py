@@ -5,6 +5,9 @@ from __future__ import unicode_literals
 
 import sys
 
+from collections import OrderedDict
+from logging import getLogger
+
 if sys.version_info[0] == 2:
     from urlparse import urlparse
 else:
@@ -12,10 +15,19 @@ else:
 
 from travispy import Build, Job, Repo
 
+__logs__ = getLogger(__package__)
+
+# Attributes of Target which are part of its key
+_KEY_FIELDS = frozenset(['user', 'project', 'build_id', 'job_id',
+                         'build_number', 'job_number'])
+
 
 class Target(object):
     """Identifier of a target resource."""
 
+    __slots__ = ('user', 'project', 'build_id', 'job_id',
+                 'build_number', 'job_number', 'state', '_key', '_hash')
+
     def __init__(self, user=None, project=None, build_id=None, job_id=None,
                  build_number=None, job_number=None, slug=None):
         """
@@ -27,6 +39,7 @@ class Target(object):
         e.g. within a repo, a logical number '10.2' is the second job
         of the tenth build.
         """
+        self._key = self._hash = None
         self.user = user
         self.project = project
         if slug:
@@ -44,6 +57,13 @@ class Target(object):
         self.job_number = job_number
         self.state = None
 
+    def __setattr__(self, name, value):
+        """Set an attribute, invalidating the cached key and hash."""
+        object.__setattr__(self, name, value)
+        if name in _KEY_FIELDS:
+            object.__setattr__(self, '_key', None)
+            object.__setattr__(self, '_hash', None)
+
     @property
     def slug(self):
         """Get repository slug."""
@@ -102,10 +122,39 @@ class Target(object):
             return '<invalid>'
         return '<{0}: {1}>'.format(self.__class__.__name__, self.extended_slug)
 
+    @property
+    def key(self):
+        """Canonical tuple identifying the target, which is cached."""
+        if self._key is None:
+            self._key = (self.user, self.project, self.build_number,
+                         self.job_number, self.build_id, self.job_id)
+        return self._key
+
     def __eq__(self, other):
         """Compare to other for equivalence."""
+        if isinstance(other, Target):
+            return self.key == other.key
         return other == self.extended_slug
 
+    def __ne__(self, other):
+        """Compare to other for difference."""
+        return not self == other
+
+    def __hash__(self):
+        """
+        Hash of the extended slug.
+
+        Targets are equal to their extended slug, so they must hash alike
+        for lookups of strings in sets and dicts of targets.  The hash is
+        cached until an attribute of the key is changed.
+        """
+        if self._hash is None:
+            if not self.user or not self.project:
+                self._hash = hash(self.key)
+            else:
+                self._hash = hash(self.extended_slug)
+        return self._hash
+
     @classmethod
     def from_simple_slug(cls, slug):
         """Return an Target from a slug containing user and project."""
@@ -193,3 +242,46 @@ class Target(object):
             return _obj
         else:
             raise AssertionError('unknown object {0!r}'.format(obj))
+
+
+class TargetSet(object):
+    """Ordered collection of targets, ignoring duplicates."""
+
+    def __init__(self, targets=()):
+        """Constructor."""
+        self._targets = OrderedDict()
+        self.update(targets)
+
+    def add(self, target):
+        """
+        Add a target, unless it is already present.
+
+        travispy objects are converted to a Target.
+        Returns True if the target was added.
+        """
+        if not isinstance(target, Target):
+            target = Target._from_travispy_obj(target)
+
+        if target in self._targets:
+            __logs__.debug('duplicate target {0}'.format(target))
+            return False
+
+        self._targets[target] = None
+        return True
+
+    def update(self, targets):
+        """Add many targets."""
+        for target in targets:
+            self.add(target)
+
+    def __contains__(self, target):
+        """Check whether target is present."""
+        return target in self._targets
+
+    def __iter__(self):
+        """Iterate over the targets in the order they were added."""
+        return iter(self._targets)
+
+    def __len__(self):
+        """Number of targets."""
+        return len(self._targets)
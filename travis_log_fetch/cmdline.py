@@ -5,26 +5,31 @@ from __future__ import unicode_literals
 
 import logging
 
-from itertools import islice
-
 from logging import getLogger
 
 from travis_log_fetch import config
 
-from travis_log_fetch._target import Target
+from travis_log_fetch._target import Target, TargetSet
 
 from travis_log_fetch.get import (
     get_completed,
-    get_forks,
-    get_historical_builds,
-    get_jobs,
+    get_many_forks,
     get_travis_repos,
     get_user_repos,
+    iter_jobs,
+    iter_recent_builds,
+    use_missing_repos,
 )
 from travis_log_fetch._store import (
-    download_job_log,
+    StoreIndex,
+    clean,
+    download_job_logs,
     get_stored_repo_slugs,
-    skip_stored,
+    iter_skip_fresh,
+    iter_skip_stored,
+    new_log_session,
+    remove_temp_files,
+    reshard,
 )
 
 
@@ -43,6 +48,23 @@ def main():
 
     __logs__.debug('{0!r}'.format(options))
 
+    if options.index:
+        index = StoreIndex(options.dir)
+        index.refresh()
+        # The refresh has found the temporary files, without another walk
+        remove_temp_files(options.dir, index)
+    else:
+        index = None
+
+    if options.clean:
+        clean(options.dir, options.format, index, options.dry_run)
+        return
+
+    if options.reshard:
+        reshard(options.dir, options.reshard, options.format, index,
+                options.dry_run)
+        return
+
     t = config._get_travispy()
     gh = config._get_github()
     if t:
@@ -50,53 +72,66 @@ def main():
     else:
         user = None
 
-    targets = []
+    if options.missing_expiry:
+        use_missing_repos(options.dir, options.missing_expiry * 24 * 60 * 60)
+
+    targets = TargetSet()
 
     for target_string in options.targets:
         if '://' in target_string:
             identifier = Target.from_url(target_string)
-            targets.append(identifier)
+            targets.add(identifier)
         else:
             identifier = Target.from_extended_slug(target_string)
-            targets.append(identifier)
+            targets.add(identifier)
 
     if options.refresh:
-        slugs = get_stored_repo_slugs(options.dir, options.format)
+        slugs = get_stored_repo_slugs(options.dir, options.format, index)
         for slug in slugs:
             identifier = Target.from_simple_slug(slug)
-            targets.append(identifier)
+            targets.add(identifier)
 
     if options.self:
         assert user
-        targets += get_user_repos(t, user)
+        targets.update(get_user_repos(t, user))
+
+    workers = options.jobs if options.engine == 'threaded' else 1
 
     if options.forks:
-        for target in targets:
-            slugs = get_forks(gh, target.slug)
-            forks = get_travis_repos(t, slugs)
-            targets += forks
+        # Forks are only fetched for the targets found above
+        slugs = get_many_forks(gh, [target.slug for target in targets],
+                               options.forks_pushed_since, workers)
+        targets.update(get_travis_repos(t, slugs, workers))
 
     if options.all or options.old:
         count = None if options.all else options.count
-        new_targets = []
-        for target in targets:
-            new_targets += list(islice(
-                get_historical_builds(t, target.slug, _load_jobs=False),
-                count))
-
-        targets = new_targets
-
-    # TODO: dont enumerate jobs if the files are all dated after the build end
-    # TODO: enumerate all files starting with the job number,
-    # and delete -started, -etc, when state is 'passed.
+        targets = iter_recent_builds(t, targets, count, workers)
 
+    # Without an index, temporary files are swept using the scan of
+    # stored logs, without another walk
     if not options.force:
-        targets = skip_stored(targets, options.dir, options.format)
+        targets = iter_skip_stored(targets, options.dir, options.format,
+                                   index, sweep=not index)
+    elif options.all or options.old:
+        # Only builds with logs of every job, all up to date, are skipped
+        targets = iter_skip_fresh(targets, options.dir, options.format,
+                                  index, sweep=not index)
 
-    jobs = get_jobs(t, targets)
+    # Each stage is a generator, so logs are downloaded while the
+    # targets are still being resolved.
+    jobs = iter_jobs(t, targets, workers)
 
     if options.wait:
         jobs = get_completed(t, jobs, options.sleep)
 
-    for job in jobs:
-        download_job_log(options.dir, job, options.format)
+    session = config._mount_http_adapter(new_log_session())
+
+    download_job_logs(options.dir, jobs, options.format, index, options.jobs,
+                      session, options.stream, options.compress,
+                      config._get_validator_cache(), options.dedup)
+
+    budgets = config._get_rate_limiter().remaining()
+    for host, remaining in sorted(budgets.items()):
+        if remaining is not None:
+            __logs__.info('{0} requests remaining for {1}'.format(
+                remaining, host))
@@ -11,13 +11,31 @@ from textwrap import dedent
 
 import configargparse
 
+import dateutil.parser
+
 import github3
 
+from requests.packages.urllib3.util.retry import Retry
+
 import travispy
 
+from travis_log_fetch._http import (
+    ConditionalAdapter,
+    RateLimitAdapter,
+    RateLimiter,
+    ResponseCache,
+    ValidatorCache,
+)
+
 _options = None
 _travispy = None
 _github = None
+_http_adapter = None
+_validator_cache = None
+_response_cache = None
+_rate_limiter = None
+
+_RETRY_STATUSES = (500, 502, 503, 504)
 
 __logs__ = getLogger(__package__)
 
@@ -46,8 +64,11 @@ def get_parser():
     parser.add('-v', '--verbose', help='verbose', action='store_true')
     parser.add('-r', '--refresh', help='refresh', action='store_true')
     parser.add('--forks', help='fetch forks', action='store_true')
+    parser.add('--forks-pushed-since', help='only fetch forks pushed to '
+               'since this date', type=dateutil.parser.parse)
     parser.add('-f', '--force', help='force', action='store_true')
-    parser.add('--format', help='log filename format',
+    parser.add('--format', help='log filename format; '
+               '{job.build_bucket} shards builds into directories of 1000',
                default='{job.repository.slug}/{job.number}-{job.state}.txt')
     parser.add('-a', '--all', help='all', action='store_true')
     parser.add('-o', '--old', help='old', action='store_true')
@@ -58,6 +79,47 @@ def get_parser():
                type=int, default=30)
     parser.add('--count', help='number of old logs to fetch',
                type=int, default=10)
+    parser.add('--index', help='keep an index of stored logs',
+               action='store_true')
+    parser.add('--clean', help='delete logs superseded by a final state log '
+               'of the same job, instead of fetching', action='store_true')
+    parser.add('--reshard', metavar='OLD_FORMAT',
+               help='move stored logs from this filename format to '
+               '--format, instead of fetching')
+    parser.add('-n', '--dry-run', help='only report what --clean or '
+               '--reshard would change', action='store_true')
+    parser.add('-j', '--jobs', help='number of concurrent log downloads',
+               type=int, default=1)
+    parser.add('--engine', help='fetch engine; threaded resolves targets '
+               'concurrently using --jobs threads',
+               choices=['sync', 'threaded'], default='sync')
+    parser.add('--stream', help='stream logs to disk while downloading',
+               action='store_true')
+    parser.add('--compress', help='compress stored logs',
+               choices=['gzip', 'xz', 'zstd'])
+    parser.add('--dedup', help='store identical logs once, using links',
+               action='store_true')
+    parser.add('--http-cache', help='make conditional HTTP requests',
+               action='store_true')
+    parser.add('--cache-size', help='API responses cached in memory',
+               type=int, default=1000)
+    parser.add('--cache-ttl',
+               help='seconds to cache API responses which may change',
+               type=int, default=10)
+    parser.add('--response-cache', help='keep API responses on disk',
+               action='store_true')
+    parser.add('--missing-expiry', help='days to remember repos which are '
+               'not on Travis; 0 to not remember between runs',
+               type=float, default=0)
+    parser.add('--pool-size', help='HTTP connections kept alive per host',
+               type=int, default=10)
+    parser.add('--retries', help='HTTP retries on connection errors',
+               type=int, default=3)
+    parser.add('--backoff', help='HTTP retry backoff factor in seconds',
+               type=float, default=0.5)
+    parser.add('--rate-limit', help='maximum HTTP requests per second to '
+               'each host; 0 to only follow the rate limit headers',
+               type=float, default=0)
     parser.add('targets', nargs='*', help='targets')
 
     return parser
@@ -90,6 +152,88 @@ def get_options():
     return _options
 
 
+def _get_validator_cache():
+    """Get HTTP validator cache, if enabled."""
+    global _validator_cache
+
+    if not _validator_cache:
+        options = get_options()
+        if options.http_cache:
+            _validator_cache = ValidatorCache(options.dir)
+
+    return _validator_cache
+
+
+def _get_response_cache():
+    """Get API response cache."""
+    global _response_cache
+
+    if not _response_cache:
+        options = get_options()
+        base_dir = options.dir if options.response_cache else None
+        _response_cache = ResponseCache(options.cache_size, options.cache_ttl,
+                                        base_dir)
+
+    return _response_cache
+
+
+def _get_rate_limiter():
+    """Get the rate limiter shared by the Travis and GitHub sessions."""
+    global _rate_limiter
+
+    if not _rate_limiter:
+        options = get_options()
+        _rate_limiter = RateLimiter(options.rate_limit or None)
+
+    return _rate_limiter
+
+
+def _get_retry():
+    """
+    Get the retry policy of HTTP adapters.
+
+    The last response is returned once retries are exhausted, so server
+    errors are still reported by the client which made the request.
+    """
+    options = get_options()
+    return Retry(total=options.retries,
+                 backoff_factor=options.backoff,
+                 status_forcelist=_RETRY_STATUSES,
+                 raise_on_status=False)
+
+
+def _get_http_adapter():
+    """
+    Get the connection pooling HTTP adapter shared by all sessions.
+
+    The pool blocks when all connections to a host are in use, limiting
+    the concurrent requests per host to the pool size.
+    """
+    global _http_adapter
+
+    if not _http_adapter:
+        options = get_options()
+        pool_size = max(options.pool_size, options.jobs)
+        _http_adapter = ConditionalAdapter(cache=_get_validator_cache(),
+                                           responses=_get_response_cache(),
+                                           limiter=_get_rate_limiter(),
+                                           pool_connections=pool_size,
+                                           pool_maxsize=pool_size,
+                                           pool_block=True,
+                                           max_retries=_get_retry())
+        __logs__.debug('HTTP pool of {0} connections'.format(pool_size))
+
+    return _http_adapter
+
+
+def _mount_http_adapter(session):
+    """Use the shared HTTP adapter for a requests session."""
+    adapter = _get_http_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 def _get_travispy():
     """Get travis-ci handle."""
     global _travispy
@@ -104,6 +248,8 @@ def _get_travispy():
             _travispy = travispy.TravisPy(uri=options.api)
             __logs__.debug('anon travis-ci activated')
 
+        _mount_http_adapter(_travispy._session)
+
     return _travispy
 
 
@@ -121,4 +267,13 @@ def _get_github():
             _github = github3.GitHub()
             __logs__.debug('anon github activated')
 
+        # GitHub responses are not cached, as github3 needs their headers
+        options = get_options()
+        adapter = RateLimitAdapter(limiter=_get_rate_limiter(),
+                                   pool_connections=options.pool_size,
+                                   pool_maxsize=options.pool_size,
+                                   max_retries=_get_retry())
+        _github.session.mount('https://', adapter)
+        _github.session.mount('http://', adapter)
+
     return _github
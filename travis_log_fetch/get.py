@@ -3,116 +3,451 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import calendar
+import itertools
+import os
+import sqlite3
+import threading
+
+from functools import partial
+from heapq import heappop, heappush
+from itertools import islice
 from logging import getLogger
+from multiprocessing.pool import ThreadPool
 
-from time import sleep
+from time import sleep, time
+
+import dateutil.parser
+import dateutil.tz
 
 import travispy
 
+from travis_log_fetch import _pool
 from travis_log_fetch._target import Target
 
 __logs__ = getLogger(__package__)
 
+# Build ids keyed by API URI, repo slug and build number
+_build_ids = {}
+
+# Repo slugs keyed by API URI and repo id, of builds listed by slug
+_repo_slugs = {}
+
+# Number of job ids requested at once
+_JOB_BATCH_SIZE = 50
+
+# Number of concurrent requests when jobs can not be fetched in a batch
+_JOB_WORKERS = 8
+
+# API URIs which do not support fetching jobs by multiple ids
+_no_job_batches = set()
+
+
+# Shortest time in seconds between polls of a pending job
+_MIN_POLL_TIME = 5
+
+# Longest time between polls of a pending job, as a multiple of --sleep
+_MAX_POLL_FACTOR = 4
+
+
+class MissingRepos(object):
+    """
+    Slugs not found on Travis, keyed by API URI and slug.
+
+    If base_dir is given, the slugs are also kept in a SQLite database in
+    that directory, and are forgotten after expiry seconds.
+    """
+
+    filename = '.travis_log_fetch.missing.sqlite'
+
+    def __init__(self, base_dir=None, expiry=None):
+        """Constructor."""
+        self._keys = set()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if base_dir:
+            if not os.path.isdir(base_dir):
+                os.makedirs(base_dir)
+            self._db = sqlite3.connect(os.path.join(base_dir, self.filename),
+                                       check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS missing '
+                '(uri TEXT, slug TEXT, checked REAL, PRIMARY KEY (uri, slug))')
+            if expiry:
+                self._db.execute('DELETE FROM missing WHERE checked < ?',
+                                 (time() - expiry, ))
+            self._db.commit()
+            self._keys.update(
+                self._db.execute('SELECT uri, slug FROM missing'))
+
+    def close(self):
+        """Close the database."""
+        if self._db:
+            self._db.close()
+
+    def add(self, key):
+        """Add a key of API URI and slug."""
+        with self._lock:
+            self._keys.add(key)
+            if self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO missing (uri, slug, checked) '
+                    'VALUES (?, ?, ?)', key + (time(), ))
+                self._db.commit()
+
+    def clear(self):
+        """Forget all keys."""
+        with self._lock:
+            self._keys.clear()
+            if self._db:
+                self._db.execute('DELETE FROM missing')
+                self._db.commit()
+
+    def __contains__(self, key):
+        """Check whether a key of API URI and slug is missing."""
+        return key in self._keys
+
+
+_missing_repos = MissingRepos()
+
+
+def use_missing_repos(base_dir, expiry):
+    """Keep slugs not found on Travis in base_dir for expiry seconds."""
+    global _missing_repos
+
+    _missing_repos = MissingRepos(base_dir, expiry)
+
+
+def _is_not_found(error):
+    """Check whether a TravisError is a 404 response."""
+    # TravisError removes the status code from its contents
+    return str(error).startswith('[404]')
+
 
 def get_travis_repo(t, slug):
     """
     Return Travis Repo or None.
 
     slugs without Travis builds emit a warning and return None.
+    Slugs which are not found are remembered, and not requested again.
     """
+    key = (t._session.uri, slug)
+    if key in _missing_repos:
+        __logs__.debug('slug {0} known to be missing on Travis'.format(slug))
+        return None
+
     try:
         return t.repo(slug)
     except travispy.errors.TravisError as e:
+        if _is_not_found(e):
+            _missing_repos.add(key)
         __logs__.error('slug {0} not found on Travis: {1}'.format(slug, e))
         return None
 
 
-def get_travis_repos(t, slugs):
+def get_travis_repos(t, slugs, workers=1):
     """
     Return list of Travis repos.
 
     slugs without Travis builds are omitted with a warning.
+    The slugs are checked by a pool of worker threads.
     """
-    repos = []
-    for slug in slugs:
-        repo = get_travis_repo(t, slug)
-        if repo:
-            repos.append(repo)
-    return repos
+    if workers <= 1:
+        repos = [get_travis_repo(t, slug) for slug in slugs]
+    else:
+        pool = ThreadPool(workers)
+        try:
+            repos = pool.map(partial(get_travis_repo, t), slugs)
+        finally:
+            pool.terminate()
+            pool.join()
 
+    return [repo for repo in repos if repo]
 
-def get_jobs(t, targets):
-    """Resolve targets to travis Jobs."""
+
+def get_build_slug(build):
+    """
+    Get the repo slug of a travispy build.
+
+    The repo of builds listed by get_historical_builds is not fetched, as
+    the slug they were listed by is used.
+    """
+    repository_id = getattr(build, 'repository_id', None)
+    session = getattr(build, '_session', None)
+    if repository_id and session:
+        key = (session.uri, repository_id)
+        if key not in _repo_slugs:
+            _repo_slugs[key] = build.repository.slug
+        return _repo_slugs[key]
+
+    return build.repository.slug
+
+
+def _get_target_jobs(t, target):
+    """Resolve one target to a list of travis Jobs."""
+    if isinstance(target, Target):
+        repo = get_travis_repo(t, target.slug)
+        if repo is None:
+            return []
+        if target.job_id:
+            jobs = t.jobs(slug=repo.slug, ids=target.job_id)
+            assert len(jobs) == 1
+            target = jobs[0]
+
+        elif target.build_id:
+            target = t.build(target.build_id)
+            assert target.repository_id == repo.id
+
+        elif target.build_number:
+            build = get_historical_build(t, target)
+            if not target.job_number:
+                target = build
+            else:
+                target = _get_build_job(t, build, target.job_number)
+
+        else:
+            target = repo
+
+    if isinstance(target, travispy.Repo):
+        if not target.last_build_id:
+            __logs__.error('No builds for {0}'.format(target.slug))
+            return []
+        target = t.build(target.last_build_id)
+
+    if isinstance(target, travispy.Build):
+        # Builds listed in pages do not include their jobs
+        _fix_build_jobs(t, target)
+        return list(target.jobs)
+    elif isinstance(target, travispy.Job):
+        return [target]
+    else:
+        raise AssertionError('Unexpected type: {0!r}'.format(target))
+
+
+def _iter_targets(targets):
+    """Iterate over targets, which may be a single target."""
     try:
-        iter(targets)
+        return iter(targets)
     except TypeError:
-        targets = [targets]
+        return iter([targets])
 
-    jobs = []
+
+def _iter_loaded_builds(t, targets):
+    """
+    Iterate over targets, adding the jobs of travispy builds in batches.
+
+    Builds listed without their jobs, such as by iter_recent_builds, are
+    held back until they have _JOB_BATCH_SIZE job ids, or another target
+    follows them, so the jobs of many builds are fetched together.
+    """
+    pending = []
+    job_count = 0
     for target in targets:
-        if isinstance(target, Target):
-            repo = get_travis_repo(t, target.slug)
-            if repo is None:
+        pending.append(target)
+        if isinstance(target, travispy.Build) and not hasattr(target, 'jobs'):
+            job_count += len(target.job_ids)
+            if job_count < _JOB_BATCH_SIZE:
                 continue
-            if target.job_id:
-                jobs = t.jobs(slug=repo.slug, ids=target.job_id)
-                assert len(jobs) == 1
-                target = jobs[0]
-
-            elif target.build_id:
-                target = t.build(target.build_id)
-                assert target.repository_id == repo.id
-
-            elif target.build_number:
-                build = get_historical_build(t, target)
-                if not target.job_number:
-                    target = build
-                else:
-                    target = _get_build_job(t, build, target.job_number)
 
-            else:
-                target = repo
+        _fix_builds_jobs(t, [item for item in pending
+                             if isinstance(item, travispy.Build)])
+        for item in pending:
+            yield item
+        pending = []
+        job_count = 0
 
-        if isinstance(target, travispy.Repo):
-            if not repo.last_build_id:
-                __logs__.error('No builds for {0}'.format(repo.slug))
-                continue
-            target = t.build(repo.last_build_id)
+    _fix_builds_jobs(t, [item for item in pending
+                         if isinstance(item, travispy.Build)])
+    for item in pending:
+        yield item
 
-        if isinstance(target, travispy.Build):
-            jobs += target.jobs
-        elif isinstance(target, travispy.Job):
-            jobs.append(target)
-        else:
-            raise AssertionError('Unexpected type: {0!r}'.format(target))
+
+def get_jobs(t, targets):
+    """Resolve targets to travis Jobs."""
+    jobs = []
+    for target in _iter_loaded_builds(t, _iter_targets(targets)):
+        jobs += _get_target_jobs(t, target)
 
     return jobs
 
 
-def get_completed(t, jobs, wait_time):
-    """Return jobs as they are completed."""
-    while jobs:
-        completed = [job for job in jobs if not job.pending]
-        for job in completed:
+def iter_jobs(t, targets, workers=1):
+    """
+    Resolve targets to travis Jobs using a pool of worker threads.
+
+    Jobs are yielded in the order of targets, as soon as each target
+    has been resolved.
+    """
+    targets = _iter_loaded_builds(t, _iter_targets(targets))
+    if workers <= 1:
+        for target in targets:
+            for job in _get_target_jobs(t, target):
+                yield job
+        return
+
+    for jobs in _pool.imap(partial(_get_target_jobs, t), targets, workers):
+        for job in jobs:
             yield job
 
-        pending = [job for job in jobs if job.pending]
-        if not pending:
+
+def _timestamp(value):
+    """Convert an API time string to seconds since the epoch."""
+    return calendar.timegm(dateutil.parser.parse(value).utctimetuple())
+
+
+def _median(values):
+    """Get the median of values, or None if there are none."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _poll_delay(job, polls, wait_time, typical_duration, now):
+    """
+    Get the number of seconds before polling a pending job again.
+
+    Queued jobs are polled every wait_time.  A started job is polled after
+    half of its expected remaining time, based on the typical duration of
+    finished jobs, and once overdue the delay doubles from _MIN_POLL_TIME
+    up to wait_time.  Without a typical duration the delay doubles from
+    wait_time.  Delays never exceed wait_time * _MAX_POLL_FACTOR.
+    """
+    min_delay = min(_MIN_POLL_TIME, wait_time)
+    max_delay = wait_time * _MAX_POLL_FACTOR
+
+    started_at = getattr(job, 'started_at', None)
+    if not started_at:
+        return wait_time
+
+    if typical_duration is None:
+        return min(wait_time * 2 ** polls, max_delay)
+
+    remaining = _timestamp(started_at) + typical_duration - now
+    if remaining > 0:
+        return min(max(remaining / 2, min_delay), max_delay)
+
+    return min(min_delay * 2 ** polls, wait_time)
+
+
+def get_completed(t, jobs, wait_time, workers=_JOB_WORKERS):
+    """
+    Return jobs as they are completed.
+
+    Each pending job is polled on its own schedule, see _poll_delay, by a
+    pool of worker threads, and is yielded as soon as it has finished.
+    """
+    durations = []
+    queue = []
+    sequence = itertools.count()
+
+    def _finished(job):
+        if getattr(job, 'duration', None):
+            durations.append(job.duration)
+        return job
+
+    def _schedule(job, polls):
+        now = time()
+        delay = _poll_delay(job, polls, wait_time, _median(durations), now)
+        heappush(queue, (now + delay, next(sequence), job, polls))
+
+    for job in jobs:
+        if job.pending:
+            _schedule(job, 0)
+        else:
+            yield _finished(job)
+
+    if not queue:
+        return
+
+    def _poll(item):
+        due, _, job, polls = item
+        return t.job(job.id), polls
+
+    pool = ThreadPool(workers)
+    try:
+        while queue:
+            delay = queue[0][0] - time()
+            if delay > 0:
+                __logs__.info('waiting {0:.0f} seconds for pending {1}'.format(
+                    delay, sorted(item[2].id for item in queue)))
+                sleep(delay)
+
+            now = time()
+            due = []
+            while queue and queue[0][0] <= now:
+                due.append(heappop(queue))
+
+            for job, polls in pool.imap_unordered(_poll, due):
+                if job.pending:
+                    _schedule(job, polls + 1)
+                else:
+                    yield _finished(job)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _get_jobs_by_id(t, job_ids):
+    """
+    Get jobs in batches of ids.
+
+    Returns None if the API does not return exactly the requested jobs.
+    """
+    jobs = []
+    for i in range(0, len(job_ids), _JOB_BATCH_SIZE):
+        batch = job_ids[i:i + _JOB_BATCH_SIZE]
+        try:
+            batch_jobs = t.jobs(ids=','.join(str(job_id) for job_id in batch))
+        except travispy.errors.TravisError as e:
+            __logs__.debug('fetching jobs by ids failed: {0}'.format(e))
             return
 
-        __logs__.info('waiting {0} seconds for pending {1}'.format(
-            wait_time, list(job.id for job in pending)))
-        sleep(wait_time)
-        jobs = [t.job(job.id) for job in pending]
+        if sorted(job.id for job in batch_jobs) != sorted(batch):
+            __logs__.debug('fetching jobs by ids returned {0} for {1}'.format(
+                [job.id for job in batch_jobs], batch))
+            return
+
+        jobs += batch_jobs
+
+    return jobs
+
+
+def _fix_builds_jobs(t, builds):
+    """Add the jobs attribute to many builds."""
+    builds = [build for build in builds if not hasattr(build, 'jobs')]
+    if not builds:
+        return
+
+    job_ids = []
+    for build in builds:
+        assert hasattr(build, 'job_ids')
+        job_ids += build.job_ids
+
+    jobs = None
+    if t._session.uri not in _no_job_batches:
+        jobs = _get_jobs_by_id(t, job_ids)
+        if jobs is None:
+            _no_job_batches.add(t._session.uri)
+
+    if jobs is None:
+        # FIXME(upstream): t.jobs(ids=build.job_ids) doesnt work
+        pool = ThreadPool(min(_JOB_WORKERS, len(job_ids)) or 1)
+        try:
+            jobs = pool.map(t.job, job_ids)
+        finally:
+            pool.close()
+            pool.join()
+
+    jobs = dict((job.id, job) for job in jobs)
+    for build in builds:
+        build.jobs = [jobs[job_id] for job_id in build.job_ids]
 
 
 def _fix_build_jobs(t, build):
     """Add the jobs attribute."""
-    if not hasattr(build, 'jobs'):
-        assert hasattr(build, 'job_ids')
-        # FIXME(upstream): this doesnt work
-        # build.jobs = t.jobs(ids=build.job_ids)
-        build.jobs = [t.job(job_id) for job_id in build.job_ids]
+    _fix_builds_jobs(t, [build])
 
 
 def get_historical_builds(t, repo, _after=None, _load_jobs=True):
@@ -131,11 +466,14 @@ def get_historical_builds(t, repo, _after=None, _load_jobs=True):
         __logs__.debug('fetched {0} builds after {1}'.format(
             len(builds), _after))
 
+        if _load_jobs:
+            _fix_builds_jobs(t, builds)
+
         for build in builds:
             build_number = int(build.number)
-
-            if _load_jobs:
-                _fix_build_jobs(t, build)
+            repository_id = getattr(build, 'repository_id', None)
+            if repository_id:
+                _repo_slugs[(t._session.uri, repository_id)] = slug
 
             if previous and build_number == int(previous.number):
                 __logs__.warning(
@@ -148,6 +486,37 @@ def get_historical_builds(t, repo, _after=None, _load_jobs=True):
         builds = t.builds(slug=slug, after_number=_after)
 
 
+def _iter_recent_builds(t, count, target):
+    """Iterate over up to count recent builds of target."""
+    return islice(get_historical_builds(t, target.slug, _load_jobs=False),
+                  count)
+
+
+def _get_recent_builds(t, count, target):
+    """Get up to count recent builds of target."""
+    return list(_iter_recent_builds(t, count, target))
+
+
+def iter_recent_builds(t, targets, count=None, workers=1):
+    """
+    Get up to count recent builds of each target.
+
+    With one worker, builds are yielded as each page is fetched.
+    Otherwise the builds of each target are fetched by a pool of worker
+    threads, and yielded in the order of targets.
+    """
+    if workers <= 1:
+        for target in targets:
+            for build in _iter_recent_builds(t, count, target):
+                yield build
+        return
+
+    for builds in _pool.imap(partial(_get_recent_builds, t, count),
+                             targets, workers):
+        for build in builds:
+            yield build
+
+
 def _get_build_job(t, build, job_number):
     """Get logical job from build."""
     _fix_build_jobs(t, build)
@@ -165,12 +534,23 @@ def _get_build_job(t, build, job_number):
 
 
 def get_historical_build(t, target):
-    """Get historical build."""
+    """
+    Get historical build.
+
+    Only the page of builds which starts with the target build is fetched,
+    and then the jobs of the matching build are loaded.  The build id is
+    remembered, so later lookups of the same build need one request.
+    """
     assert isinstance(target, Target)
     assert target.build_number
-    repo = get_travis_repo(t, target.slug)
+
+    key = (t._session.uri, target.slug, target.build_number)
+    if key in _build_ids:
+        return t.build(_build_ids[key])
+
     after = target.build_number + 1
-    builds = get_historical_builds(t, repo, _after=after)
+    builds = get_historical_builds(t, target.slug, _after=after,
+                                   _load_jobs=False)
 
     # As there can be duplicate build numbers, fetch one more
     # to detect duplicates
@@ -187,12 +567,12 @@ def get_historical_build(t, target):
             found = build
 
         if build_number < target.build_number:
-            if found:
-                return found
             break
 
     if found:
-        return found
+        _build_ids[key] = found.id
+        # Fetching the build by id includes its jobs
+        return t.build(found.id)
 
     raise AssertionError('could not find build {0}'.format(target))
 
@@ -212,8 +592,23 @@ def get_user_repos(t, user):
     return t.repos(member=user)
 
 
-def get_forks(gh, slug):
-    """Get github fork slugs."""
+def _get_pushed_at(fork):
+    """Get the time of the last push to a github repository."""
+    pushed_at = getattr(fork, 'pushed_at', None)
+    if pushed_at is None:
+        # github3 ShortRepository only has it in the raw data
+        pushed_at = fork.as_dict().get('pushed_at')
+        if pushed_at:
+            pushed_at = dateutil.parser.parse(pushed_at)
+    return pushed_at
+
+
+def get_forks(gh, slug, pushed_after=None):
+    """
+    Get github fork slugs.
+
+    If pushed_after is given, forks without a later push are omitted.
+    """
     username, project = slug.rsplit('/', 1)
     repo = gh.repository(username, project)
     assert repo
@@ -223,4 +618,50 @@ def get_forks(gh, slug):
     else:
         forks = list(repo.forks())
 
+    if pushed_after:
+        if not pushed_after.tzinfo:
+            pushed_after = pushed_after.replace(tzinfo=dateutil.tz.tzutc())
+        active = []
+        for fork in forks:
+            pushed_at = _get_pushed_at(fork)
+            if pushed_at and pushed_at > pushed_after:
+                active.append(fork)
+            else:
+                __logs__.debug('skipping inactive fork {0}'.format(
+                    fork.full_name))
+        forks = active
+
     return [fork.full_name for fork in forks]
+
+
+def _unique(items):
+    """Get list of items without duplicates, in their original order."""
+    seen = set()
+    unique = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            unique.append(item)
+    return unique
+
+
+def get_many_forks(gh, slugs, pushed_after=None, workers=1):
+    """
+    Get github fork slugs of many repositories using worker threads.
+
+    Each repository is only listed once, and each fork is only returned
+    once, in the order of slugs.
+    """
+    slugs = _unique(slugs)
+    get_repo_forks = partial(get_forks, gh, pushed_after=pushed_after)
+    if workers <= 1:
+        results = [get_repo_forks(slug) for slug in slugs]
+    else:
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(get_repo_forks, slugs)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    return _unique(fork for forks in results for fork in forks)